@@ -29,6 +29,63 @@ cors_allow_origins = (
     app.node.try_get_context("cors_allow_origins") or "https://auth.magic.link"
 )
 
+# Optionally deploy the asynchronous bulk job API backed by SQS and S3.
+# example: "cdk synth --context enable_bulk_jobs=true"
+enable_bulk_jobs = str(app.node.try_get_context("enable_bulk_jobs")).lower() == "true"
+
+# Optionally deploy the API as a long-running ECS Fargate service behind an ALB.
+# example: "cdk synth --context enable_fargate=true"
+enable_fargate = str(app.node.try_get_context("enable_fargate")).lower() == "true"
+
+# The load balancer is internal to its VPC unless it is given a domain in a
+# Route 53 hosted zone, in which case it is public and only serves HTTPS.
+# example: "cdk synth --context enable_fargate=true
+#   --context fargate_domain_name=dkms.example.com
+#   --context fargate_hosted_zone_id=Z0123456789 --context fargate_hosted_zone_name=example.com"
+fargate_domain_name = app.node.try_get_context("fargate_domain_name")
+fargate_hosted_zone_id = app.node.try_get_context("fargate_hosted_zone_id")
+fargate_hosted_zone_name = app.node.try_get_context("fargate_hosted_zone_name")
+if fargate_domain_name is not None:
+    assert (
+        fargate_hosted_zone_id is not None and fargate_hosted_zone_name is not None
+    ), "If a Fargate domain name is provided, its hosted zone must also be provided"
+
+# Optionally expose per-container runtime metrics at /metrics to callers whose
+# JWT carries this claim.
+# example: "cdk synth --context metrics_admin_claim=dkms_admin"
+metrics_admin_claim = app.node.try_get_context("metrics_admin_claim")
+
+# Optionally rate limit each tenant (by JWT ewi) in requests per second, and
+# share the token buckets between lambda containers through DynamoDB.
+# example: "cdk synth --context tenant_rate_limit=20 --context tenant_burst_limit=40"
+tenant_rate_limit = app.node.try_get_context("tenant_rate_limit")
+tenant_burst_limit = app.node.try_get_context("tenant_burst_limit")
+shared_tenant_limits = (
+    str(app.node.try_get_context("shared_tenant_limits")).lower() == "true"
+)
+
+# Optionally throttle the whole API at the gateway, in requests per second.
+# example: "cdk synth --context api_throttle_rate_limit=500"
+api_throttle_rate_limit = app.node.try_get_context("api_throttle_rate_limit")
+api_throttle_burst_limit = app.node.try_get_context("api_throttle_burst_limit")
+
+# Optionally call KMS through the built-in SigV4 client instead of boto3, which
+# keeps boto3 off the lambda cold start path.
+# example: "cdk synth --context kms_client=sigv4"
+kms_client = app.node.try_get_context("kms_client") or "boto3"
+
+# Optionally enable X-Ray active tracing and send spans for authentication,
+# JWKS refreshes, KMS calls and serialization. Requests without an upstream
+# sampling decision (e.g. through the load balancer) are sampled at the rate.
+# example: "cdk synth --context enable_tracing=true --context trace_sample_rate=0.1"
+enable_tracing = str(app.node.try_get_context("enable_tracing")).lower() == "true"
+trace_sample_rate = app.node.try_get_context("trace_sample_rate")
+
+# Optionally create a KMS key for each of these tenants (by JWT ewi) and route
+# their requests to it. Other tenants keep using the shared key.
+# example: "cdk synth --context tenant_keys=app-1,app-2"
+tenant_keys = app.node.try_get_context("tenant_keys")
+
 
 DKMSCustomerAPIStack(
     app,
@@ -38,5 +95,24 @@ DKMSCustomerAPIStack(
     cors_allow_origins=cors_allow_origins,
     domain_name=domain_name,
     acm_cert_arn=acm_cert_arn,
+    enable_bulk_jobs=enable_bulk_jobs,
+    enable_fargate=enable_fargate,
+    fargate_domain_name=fargate_domain_name,
+    fargate_hosted_zone_id=fargate_hosted_zone_id,
+    fargate_hosted_zone_name=fargate_hosted_zone_name,
+    metrics_admin_claim=metrics_admin_claim,
+    tenant_rate_limit=float(tenant_rate_limit) if tenant_rate_limit else None,
+    tenant_burst_limit=int(tenant_burst_limit) if tenant_burst_limit else None,
+    shared_tenant_limits=shared_tenant_limits,
+    api_throttle_rate_limit=(
+        float(api_throttle_rate_limit) if api_throttle_rate_limit else None
+    ),
+    api_throttle_burst_limit=(
+        int(api_throttle_burst_limit) if api_throttle_burst_limit else None
+    ),
+    kms_client=kms_client,
+    enable_tracing=enable_tracing,
+    trace_sample_rate=float(trace_sample_rate) if trace_sample_rate else None,
+    tenant_keys=tenant_keys.split(",") if tenant_keys else None,
 )
 app.synth()
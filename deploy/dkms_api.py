@@ -1,11 +1,23 @@
+import json
+
 from aws_cdk import (
     CfnOutput,
     Duration,
     RemovalPolicy,
     Stack,
     aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_kms as kms,
     aws_certificatemanager as acm,
+    aws_dynamodb as dynamodb,
+    aws_ecs as ecs,
+    aws_ecs_patterns as ecs_patterns,
+    aws_elasticloadbalancingv2 as elbv2,
+    aws_iam as iam,
+    aws_route53 as route53,
+    aws_s3 as s3,
+    aws_sqs as sqs,
+    aws_ssm as ssm,
 )
 from constructs import Construct
 
@@ -28,6 +40,21 @@ class DKMSCustomerAPIStack(Stack):
         cors_allow_origins: str,
         domain_name: str = None,
         acm_cert_arn: str = None,
+        enable_bulk_jobs: bool = False,
+        enable_fargate: bool = False,
+        fargate_domain_name: str = None,
+        fargate_hosted_zone_id: str = None,
+        fargate_hosted_zone_name: str = None,
+        metrics_admin_claim: str = None,
+        tenant_rate_limit: float = None,
+        tenant_burst_limit: int = None,
+        shared_tenant_limits: bool = False,
+        api_throttle_rate_limit: float = None,
+        api_throttle_burst_limit: int = None,
+        kms_client: str = "boto3",
+        enable_tracing: bool = False,
+        trace_sample_rate: float = None,
+        tenant_keys: list = None,
         **kwargs,
     ) -> None:
         """Initialize the stack."""
@@ -37,6 +64,25 @@ class DKMSCustomerAPIStack(Stack):
         self.domain_name = domain_name
         self.acm_cert_arn = acm_cert_arn
         self.cors_allow_origins = cors_allow_origins
+        self.enable_bulk_jobs = enable_bulk_jobs
+        self.enable_fargate = enable_fargate
+        assert fargate_domain_name is None or (
+            fargate_hosted_zone_id is not None and fargate_hosted_zone_name is not None
+        ), "fargate_domain_name requires the id and name of its Route 53 hosted zone"
+        self.fargate_domain_name = fargate_domain_name
+        self.fargate_hosted_zone_id = fargate_hosted_zone_id
+        self.fargate_hosted_zone_name = fargate_hosted_zone_name
+        self.metrics_admin_claim = metrics_admin_claim
+        self.tenant_rate_limit = tenant_rate_limit
+        self.tenant_burst_limit = tenant_burst_limit
+        self.shared_tenant_limits = shared_tenant_limits
+        self.api_throttle_rate_limit = api_throttle_rate_limit
+        self.api_throttle_burst_limit = api_throttle_burst_limit
+        assert kms_client in ("boto3", "sigv4"), "kms_client must be boto3 or sigv4"
+        self.kms_client = kms_client
+        self.enable_tracing = enable_tracing
+        self.trace_sample_rate = trace_sample_rate
+        self.tenant_keys = tenant_keys or []
 
         # Create a KMS key
         self.kms_key = self.deploy_kms_key()
@@ -47,6 +93,18 @@ class DKMSCustomerAPIStack(Stack):
         # Grant the lambda permission to use the kms key
         self.kms_key.grant_encrypt_decrypt(self.dkms_lambda)
 
+        # Optionally give tenants their own KMS keys, routed by a parameter
+        if self.tenant_keys:
+            self.deploy_tenant_keys()
+
+        # Optionally rate limit each tenant, sharing buckets through DynamoDB
+        if self.tenant_rate_limit is not None:
+            self.deploy_tenant_rate_limits()
+
+        # Optionally create the bucket, queue and worker for bulk jobs
+        if self.enable_bulk_jobs:
+            self.deploy_bulk_jobs()
+
         # Create an API Gateway V2 API
         self.dkms_api = self.deploy_dkms_api()
 
@@ -58,6 +116,13 @@ class DKMSCustomerAPIStack(Stack):
             description="DKMS Customer API URL",
         )
 
+        # Optionally serve the same API from a long-running container behind
+        # an application load balancer. The pattern outputs the service URL.
+        # The load balancer is only public when it has its own domain to
+        # serve HTTPS on; otherwise it is internal to the VPC.
+        if self.enable_fargate:
+            self.dkms_service = self.deploy_dkms_service()
+
     def deploy_kms_key(self) -> kms.Key:
         """Create a KMS key for encrypting and decrypting customer data."""
         return kms.Key(
@@ -79,13 +144,312 @@ class DKMSCustomerAPIStack(Stack):
             handler="handler",
             timeout=Duration.seconds(30),
             memory_size=128,
+            tracing=lambda_.Tracing.ACTIVE if self.enable_tracing else None,
             environment={
                 "DKMS_KMS_KEY_ID": self.kms_key.key_id,
                 "JWKS_URL": self.jwks_url,
                 "CORS_ALLOW_ORIGINS": self.cors_allow_origins,
+                **self.metrics_environment(),
+                **self.kms_client_environment(),
+                **self.tracing_environment(),
             },
         )
 
+    def kms_client_environment(self) -> dict:
+        """Return the environment selecting the KMS client the handler uses."""
+        if self.kms_client == "boto3":
+            return {}
+        return {"DKMS_KMS_CLIENT": self.kms_client}
+
+    def tracing_environment(self) -> dict:
+        """Return the environment sending handler spans to X-Ray."""
+        if not self.enable_tracing:
+            return {}
+        environment = {"DKMS_TRACING": "xray"}
+        if self.trace_sample_rate is not None:
+            environment["DKMS_TRACE_SAMPLE_RATE"] = str(self.trace_sample_rate)
+        return environment
+
+    def metrics_environment(self) -> dict:
+        """Return the environment enabling the admin-only /metrics route."""
+        if self.metrics_admin_claim is None:
+            return {}
+        return {"DKMS_METRICS_ADMIN_CLAIM": self.metrics_admin_claim}
+
+    def deploy_tenant_keys(self) -> None:
+        """Create a KMS key per tenant and the key routing map for the handler."""
+        routes = {}
+        self.tenant_kms_keys = []
+        for tenant in self.tenant_keys:
+            alias = f"dkms-customer-key-{self.env_name}-{tenant}"
+            self.tenant_kms_keys.append(
+                kms.Key(
+                    self,
+                    id=f"dkms-customer-key-{tenant}",
+                    alias=alias,
+                    description=f"Key for encrypting and decrypting data of {tenant}",
+                    removal_policy=RemovalPolicy.RETAIN,
+                )
+            )
+            routes[tenant] = f"alias/{alias}"
+        self.key_routes_parameter = ssm.StringParameter(
+            self,
+            id="dkms-customer-key-routes",
+            parameter_name=f"/dkms-customer-api/{self.env_name}/key-routes",
+            string_value=json.dumps(routes, sort_keys=True),
+            description="Map of tenants to their DKMS KMS keys",
+        )
+        self.grant_tenant_keys(self.dkms_lambda)
+        for key, value in self.key_routing_environment().items():
+            self.dkms_lambda.add_environment(key, value)
+
+    def grant_tenant_keys(self, grantee: iam.IGrantable) -> None:
+        """Let a handler read the key routing map and use the tenant keys."""
+        if not self.tenant_keys:
+            return
+        self.key_routes_parameter.grant_read(grantee)
+        # The router describes the shared key too, to know its ARN
+        self.kms_key.grant(grantee, "kms:DescribeKey")
+        for key in self.tenant_kms_keys:
+            key.grant_encrypt_decrypt(grantee)
+            key.grant(grantee, "kms:DescribeKey")
+
+    def key_routing_environment(self) -> dict:
+        """Return the environment pointing the handler at the key routing map."""
+        if not self.tenant_keys:
+            return {}
+        return {"DKMS_KEY_ROUTES_PARAMETER": self.key_routes_parameter.parameter_name}
+
+    def deploy_tenant_rate_limits(self) -> None:
+        """Configure per-tenant token buckets for the API lambda."""
+        self.tenant_table = None
+        if self.shared_tenant_limits:
+            self.tenant_table = dynamodb.Table(
+                self,
+                id="dkms-customer-tenant-buckets",
+                partition_key=dynamodb.Attribute(
+                    name="tenant", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ttl",
+                removal_policy=RemovalPolicy.DESTROY,
+            )
+        self.grant_tenant_rate_limits(self.dkms_lambda)
+        for key, value in self.tenant_rate_limit_environment().items():
+            self.dkms_lambda.add_environment(key, value)
+
+    def grant_tenant_rate_limits(self, grantee: iam.IGrantable) -> None:
+        """Let a handler use the shared token bucket table, if there is one."""
+        if self.tenant_rate_limit is not None and self.tenant_table is not None:
+            self.tenant_table.grant_read_write_data(grantee)
+
+    def tenant_rate_limit_environment(self) -> dict:
+        """Return the environment configuring per-tenant rate limits."""
+        if self.tenant_rate_limit is None:
+            return {}
+        environment = {"DKMS_TENANT_RATE": str(self.tenant_rate_limit)}
+        if self.tenant_burst_limit is not None:
+            environment["DKMS_TENANT_BURST"] = str(self.tenant_burst_limit)
+        if self.tenant_table is not None:
+            environment["DKMS_TENANT_TABLE"] = self.tenant_table.table_name
+        return environment
+
+    def deploy_bulk_jobs(self) -> None:
+        """Create the job bucket, chunk queue and worker for bulk jobs."""
+        # Job input and results contain key shares, so encrypt them at rest
+        # with the customer key and expire them once they have been collected.
+        self.job_bucket = s3.Bucket(
+            self,
+            id="dkms-customer-jobs",
+            encryption=s3.BucketEncryption.KMS,
+            encryption_key=self.kms_key,
+            # Use a bucket key so that object reads and writes do not spend
+            # the KMS request quota the worker paces itself against
+            bucket_key_enabled=True,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            enforce_ssl=True,
+            lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(1))],
+            removal_policy=RemovalPolicy.DESTROY,
+            auto_delete_objects=True,
+        )
+        job_dlq = sqs.Queue(
+            self,
+            id="dkms-customer-jobs-dlq",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            retention_period=Duration.days(14),
+        )
+        self.job_queue = sqs.Queue(
+            self,
+            id="dkms-customer-jobs-queue",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            # Must exceed the worker timeout so chunks are not redelivered
+            # while they are still being processed
+            visibility_timeout=Duration.minutes(6),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=job_dlq),
+        )
+        job_environment = self.bulk_jobs_environment()
+
+        self.job_worker_lambda = PythonFunction(
+            self,
+            id=f"magic-dkms-customer-job-worker-{self.env_name}",
+            function_name=f"magic-dkms-customer-job-worker-{self.env_name}",
+            entry="lambdas/dkms_handler",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="job_worker_handler",
+            timeout=Duration.minutes(5),
+            memory_size=128,
+            tracing=lambda_.Tracing.ACTIVE if self.enable_tracing else None,
+            environment={
+                "DKMS_KMS_KEY_ID": self.kms_key.key_id,
+                "JWKS_URL": self.jwks_url,
+                "CORS_ALLOW_ORIGINS": self.cors_allow_origins,
+                **job_environment,
+                **self.kms_client_environment(),
+                **self.tracing_environment(),
+                **self.key_routing_environment(),
+                **self.tenant_rate_limit_environment(),
+            },
+        )
+        # Each chunk message is processed at the worker's KMS rate, so the
+        # concurrency cap bounds the total KMS request rate of bulk jobs.
+        self.job_worker_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                self.job_queue,
+                batch_size=1,
+                max_concurrency=2,
+                report_batch_item_failures=True,
+            )
+        )
+        self.kms_key.grant_encrypt_decrypt(self.job_worker_lambda)
+        self.grant_tenant_keys(self.job_worker_lambda)
+        self.grant_tenant_rate_limits(self.job_worker_lambda)
+        self.job_bucket.grant_read_write(self.job_worker_lambda)
+
+        # Chunks that exhaust their deliveries are dead-lettered; record them
+        # so that their job reports FAILED instead of staying PENDING.
+        self.job_dead_letter_lambda = PythonFunction(
+            self,
+            id=f"magic-dkms-customer-job-dlq-{self.env_name}",
+            function_name=f"magic-dkms-customer-job-dlq-{self.env_name}",
+            entry="lambdas/dkms_handler",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="job_dead_letter_handler",
+            timeout=Duration.seconds(30),
+            memory_size=128,
+            environment={
+                "DKMS_KMS_KEY_ID": self.kms_key.key_id,
+                "JWKS_URL": self.jwks_url,
+                "CORS_ALLOW_ORIGINS": self.cors_allow_origins,
+                **job_environment,
+            },
+        )
+        self.job_dead_letter_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                job_dlq, batch_size=10, report_batch_item_failures=True
+            )
+        )
+        self.job_bucket.grant_read_write(self.job_dead_letter_lambda)
+
+        for key, value in job_environment.items():
+            self.dkms_lambda.add_environment(key, value)
+        self.grant_bulk_jobs(self.dkms_lambda)
+
+    def grant_bulk_jobs(self, grantee: iam.IGrantable) -> None:
+        """Let a handler submit bulk jobs and read their results."""
+        if not self.enable_bulk_jobs:
+            return
+        self.job_bucket.grant_read_write(grantee)
+        self.job_queue.grant_send_messages(grantee)
+
+    def bulk_jobs_environment(self) -> dict:
+        """Return the environment enabling the bulk job API."""
+        if not self.enable_bulk_jobs:
+            return {}
+        return {
+            "DKMS_JOB_BUCKET": self.job_bucket.bucket_name,
+            "DKMS_JOB_QUEUE_URL": self.job_queue.queue_url,
+        }
+
+    def deploy_dkms_service(
+        self,
+    ) -> ecs_patterns.ApplicationLoadBalancedFargateService:
+        """Create an ECS Fargate service running the long-running API server."""
+        domain_zone = None
+        if self.fargate_domain_name is not None:
+            # The pattern creates the alias record and a DNS validated
+            # certificate for the domain in this zone.
+            domain_zone = route53.HostedZone.from_hosted_zone_attributes(
+                self,
+                "dkms-service-zone",
+                hosted_zone_id=self.fargate_hosted_zone_id,
+                zone_name=self.fargate_hosted_zone_name,
+            )
+
+        service = ecs_patterns.ApplicationLoadBalancedFargateService(
+            self,
+            id="dkms-customer-service",
+            service_name=f"magic-dkms-customer-service-{self.env_name}",
+            cpu=256,
+            memory_limit_mib=512,
+            desired_count=2,
+            public_load_balancer=domain_zone is not None,
+            domain_name=self.fargate_domain_name,
+            domain_zone=domain_zone,
+            protocol=(
+                elbv2.ApplicationProtocol.HTTPS
+                if domain_zone is not None
+                else elbv2.ApplicationProtocol.HTTP
+            ),
+            redirect_http=domain_zone is not None,
+            task_image_options=ecs_patterns.ApplicationLoadBalancedTaskImageOptions(
+                image=ecs.ContainerImage.from_asset("lambdas/dkms_handler"),
+                container_port=8080,
+                environment={
+                    "DKMS_KMS_KEY_ID": self.kms_key.key_id,
+                    "JWKS_URL": self.jwks_url,
+                    "CORS_ALLOW_ORIGINS": self.cors_allow_origins,
+                    "AWS_DEFAULT_REGION": self.region,
+                    "DKMS_KMS_MAX_POOL_CONNECTIONS": "64",
+                    **self.metrics_environment(),
+                    **self.kms_client_environment(),
+                    **self.tracing_environment(),
+                    **self.key_routing_environment(),
+                    **self.tenant_rate_limit_environment(),
+                    **self.bulk_jobs_environment(),
+                },
+            ),
+        )
+        service.target_group.configure_health_check(path="/healthz")
+        scaling = service.service.auto_scale_task_count(min_capacity=2, max_capacity=10)
+        scaling.scale_on_cpu_utilization(
+            "dkms-customer-service-cpu-scaling", target_utilization_percent=60
+        )
+        self.kms_key.grant_encrypt_decrypt(service.task_definition.task_role)
+        self.grant_tenant_keys(service.task_definition.task_role)
+        self.grant_tenant_rate_limits(service.task_definition.task_role)
+        self.grant_bulk_jobs(service.task_definition.task_role)
+        if self.enable_tracing:
+            # Tasks share a network namespace, so the server reaches the
+            # daemon on its default address of 127.0.0.1:2000.
+            service.task_definition.add_container(
+                "xray-daemon",
+                image=ecs.ContainerImage.from_registry(
+                    "public.ecr.aws/xray/aws-xray-daemon:latest"
+                ),
+                cpu=32,
+                memory_reservation_mib=64,
+                port_mappings=[
+                    ecs.PortMapping(container_port=2000, protocol=ecs.Protocol.UDP)
+                ],
+                logging=ecs.LogDrivers.aws_logs(stream_prefix="xray-daemon"),
+            )
+            service.task_definition.task_role.add_managed_policy(
+                iam.ManagedPolicy.from_aws_managed_policy_name(
+                    "AWSXRayDaemonWriteAccess"
+                )
+            )
+        return service
+
     def deploy_dkms_api(self) -> apigwv2.HttpApi:
         """Create an API Gateway V2 API for the DKMS customer endpoint."""
         default_domain_mapping = None
@@ -127,4 +491,38 @@ class DKMSCustomerAPIStack(Stack):
             methods=[apigwv2.HttpMethod.POST, apigwv2.HttpMethod.OPTIONS],
             integration=dkms_default_integration,
         )
+        if (
+            self.api_throttle_rate_limit is not None
+            or self.api_throttle_burst_limit is not None
+        ):
+            # The alpha HttpApi construct does not expose default stage
+            # throttling, so set it on the underlying CfnStage
+            default_stage = dkms_api.default_stage.node.default_child
+            if self.api_throttle_rate_limit is not None:
+                default_stage.add_property_override(
+                    "DefaultRouteSettings.ThrottlingRateLimit",
+                    self.api_throttle_rate_limit,
+                )
+            if self.api_throttle_burst_limit is not None:
+                default_stage.add_property_override(
+                    "DefaultRouteSettings.ThrottlingBurstLimit",
+                    self.api_throttle_burst_limit,
+                )
+        if self.metrics_admin_claim is not None:
+            dkms_api.add_routes(
+                path="/metrics",
+                methods=[apigwv2.HttpMethod.GET, apigwv2.HttpMethod.OPTIONS],
+                integration=dkms_default_integration,
+            )
+        if self.enable_bulk_jobs:
+            dkms_api.add_routes(
+                path="/jobs",
+                methods=[apigwv2.HttpMethod.POST, apigwv2.HttpMethod.OPTIONS],
+                integration=dkms_default_integration,
+            )
+            dkms_api.add_routes(
+                path="/jobs/{job_id}",
+                methods=[apigwv2.HttpMethod.GET, apigwv2.HttpMethod.OPTIONS],
+                integration=dkms_default_integration,
+            )
         return dkms_api
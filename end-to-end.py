@@ -1,11 +1,33 @@
+"""Smoke test or load test a deployed DKMS customer API.
+
+Without options, runs one healthz, encrypt and decrypt against BASE_URL. With
+--duration, also drives a mix of requests at a constant, ramped or stepped
+concurrency and prints latency percentiles per route, errors by error_code,
+results per concurrency level and any failed encrypt/decrypt round trips.
+
+    BASE_URL=... JWT=... poetry run python end-to-end.py
+    BASE_URL=... JWT=... poetry run python end-to-end.py --duration 300 \\
+        --profile step --concurrency 50 --step-size 10 --mix roundtrip=1,decrypt=3
+"""
+import argparse
 import json
 import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import deque
+
 import requests
 
+from loadtest import Results, concurrency_at, parse_mix
+
 BASE_URL = os.getenv("BASE_URL")
 assert (
     BASE_URL is not None
 ), "BASE_URL environment variable must be set to a value like 'https://oon4ztxwte.execute-api.us-west-2.amazonaws.com/'"
+BASE_URL = BASE_URL.rstrip("/")
 
 JWT = os.getenv("JWT")
 assert JWT is not None, "JWT environment variable must be set"
@@ -43,10 +65,181 @@ def test_decrypt(ciphertext: str) -> str:
     return response.json()["data"]["plaintext"]
 
 
-if __name__ == "__main__":
+class LoadClient:
+    """Make API requests for one worker, reusing its connection by default."""
+
+    def __init__(self, results: Results, reuse_connections: bool, timeout: float):
+        self.results = results
+        self.reuse_connections = reuse_connections
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, route: str, level: int, payload: dict = None):
+        """Make a request, returning its data or None if it failed."""
+        headers = {"Authorization": f"Bearer {JWT}"}
+        if not self.reuse_connections:
+            headers["Connection"] = "close"
+        data = None
+        if payload is not None:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(payload)
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                "GET" if payload is None else "POST",
+                f"{BASE_URL}/{route}",
+                headers=headers,
+                data=data,
+                timeout=self.timeout,
+            )
+            latency_ms = (time.perf_counter() - started) * 1000
+            try:
+                body = response.json()
+                error_code = body.get("error_code") or (
+                    "" if response.ok else f"HTTP_{response.status_code}"
+                )
+            except ValueError:
+                body, error_code = None, f"HTTP_{response.status_code}"
+        except requests.RequestException as e:
+            latency_ms = (time.perf_counter() - started) * 1000
+            body, error_code = None, type(e).__name__
+
+        self.results.record(route, latency_ms, error_code, level)
+        return None if error_code else body.get("data", {})
+
+    def close(self):
+        self.session.close()
+
+
+class LoadTest:
+    """Drive a request mix at a concurrency that follows a load profile."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.mix = args.mix
+        self.results = Results()
+        # Encrypted shares, with their plaintexts, available to decrypt
+        self.shares = deque(maxlen=1000)
+        self.operations = {
+            "healthz": self.healthz,
+            "encrypt": self.encrypt,
+            "decrypt": self.decrypt,
+            "roundtrip": self.roundtrip,
+        }
+
+    def concurrency(self, elapsed: float) -> int:
+        """Return the number of active workers `elapsed` seconds into the test."""
+        return concurrency_at(self.args, elapsed)
+
+    def run(self) -> dict:
+        started = time.monotonic()
+        workers = [
+            threading.Thread(target=self.work, args=(index, started))
+            for index in range(self.args.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.results.report(time.monotonic() - started)
+
+    def work(self, index: int, started: float):
+        client = LoadClient(
+            self.results, not self.args.no_reuse_connections, self.args.timeout
+        )
+        operations, weights = zip(*self.mix.items())
+        try:
+            while (elapsed := time.monotonic() - started) < self.args.duration:
+                level = self.concurrency(elapsed)
+                if index >= level:
+                    time.sleep(0.05)
+                    continue
+                operation = random.choices(operations, weights)[0]
+                self.operations[operation](client, level)
+        finally:
+            client.close()
+
+    def healthz(self, client: LoadClient, level: int):
+        client.request("healthz", level)
+
+    def encrypt(self, client: LoadClient, level: int):
+        plaintext = secrets.token_hex(self.args.plaintext_size // 2)
+        data = client.request("encrypt", level, {"plaintext": plaintext})
+        if data is not None:
+            self.shares.append((plaintext, data["ciphertext"]))
+        return plaintext, data
+
+    def decrypt(self, client: LoadClient, level: int):
+        try:
+            plaintext, ciphertext = random.choice(self.shares)
+        except IndexError:
+            return self.encrypt(client, level)
+        self.verify(client, level, plaintext, ciphertext)
+
+    def roundtrip(self, client: LoadClient, level: int):
+        plaintext, data = self.encrypt(client, level)
+        if data is not None:
+            self.verify(client, level, plaintext, data["ciphertext"])
+
+    def verify(self, client: LoadClient, level: int, plaintext: str, ciphertext):
+        data = client.request("decrypt", level, {"ciphertext": ciphertext})
+        if data is not None and data.get("plaintext") != plaintext:
+            self.results.record_integrity_failure()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--duration", type=float, default=0, help="seconds of load, 0 to only smoke"
+    )
+    parser.add_argument(
+        "--profile", choices=("constant", "ramp", "step"), default="constant"
+    )
+    parser.add_argument("--concurrency", type=int, default=10, help="peak workers")
+    parser.add_argument(
+        "--start-concurrency", type=int, default=1, help="workers at the start"
+    )
+    parser.add_argument(
+        "--step-size", type=int, default=5, help="workers added per step"
+    )
+    parser.add_argument(
+        "--step-duration", type=float, default=30, help="seconds per step"
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="roundtrip=1",
+        help="weighted operations among healthz, encrypt, decrypt and roundtrip",
+    )
+    parser.add_argument("--plaintext-size", type=int, default=64, help="bytes")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout")
+    parser.add_argument(
+        "--no-reuse-connections",
+        action="store_true",
+        help="open a new connection for every request",
+    )
+    args = parser.parse_args()
+
     test_healthz()
     input = "abracadabra"
     ciphertext = test_encrypt(input)
     output = test_decrypt(ciphertext)
     assert input == output
     print(f"Success: {input} -> {ciphertext} -> {output}")
+    if not args.duration:
+        return
+
+    load_test = LoadTest(args)
+    load_test.shares.append((input, ciphertext))
+    report = load_test.run()
+    print(json.dumps(report, indent=2))
+    if report["integrity_failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
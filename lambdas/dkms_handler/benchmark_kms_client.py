@@ -0,0 +1,113 @@
+"""Compare the boto3 and SigV4 KMS clients on cold start cost and call overhead.
+
+Import time and resident memory are measured in fresh interpreters, once per
+run. Per-call overhead is measured against the local KMS stand-in over HTTP, so
+it covers signing, serialization and connection handling but not KMS itself.
+
+    poetry run python benchmark_kms_client.py --runs 5 --calls 2000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from local_kms import LocalKMS, serve_http
+
+# ru_maxrss can carry over the parent's peak across fork and exec on Linux, so
+# the peak is read from /proc where it is available.
+COLD_START = """
+import json, resource, time
+started = time.perf_counter()
+{setup}
+elapsed = time.perf_counter() - started
+try:
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+    max_rss_kb = int(status["VmHWM"].split()[0])
+except OSError:
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"import_ms": elapsed * 1000, "max_rss_kb": max_rss_kb}}))
+"""
+SETUP = {
+    "boto3": "import boto3\nboto3.client('kms', endpoint_url='{url}')",
+    "sigv4": "import sigv4_kms\nsigv4_kms.KMSClient(endpoint_url='{url}')",
+}
+
+
+def cold_start(name: str, url: str, runs: int) -> dict:
+    """Return the median import time and peak RSS of creating a client."""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                COLD_START.format(setup=SETUP[name].format(url=url)),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout
+        samples.append(json.loads(output))
+    return {
+        key: statistics.median(sample[key] for sample in samples)
+        for key in ("import_ms", "max_rss_kb")
+    }
+
+
+def call_overhead(client, calls: int) -> dict:
+    """Return latency statistics for encrypt/decrypt pairs through the client."""
+    latencies = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        blob = client.encrypt(
+            KeyId="benchmark-key",
+            Plaintext="secret",
+            EncryptionContext={"ewi": "abcd1234"},
+        )["CiphertextBlob"]
+        client.decrypt(CiphertextBlob=blob, EncryptionContext={"ewi": "abcd1234"})
+        latencies.append((time.perf_counter() - started) * 1000 / 2)
+    latencies.sort()
+    return {
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(latencies[len(latencies) // 2], 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per client")
+    parser.add_argument("--calls", type=int, default=1000, help="calls per client")
+    args = parser.parse_args()
+
+    # Dummy credentials; the stand-in checks that requests are signed, not how
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIDBENCHMARK")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    server, url = serve_http(LocalKMS())
+
+    import boto3
+    import sigv4_kms
+
+    clients = {
+        "boto3": boto3.client("kms", endpoint_url=url),
+        "sigv4": sigv4_kms.KMSClient(endpoint_url=url),
+    }
+    report = {}
+    for name, client in clients.items():
+        call_overhead(client, min(args.calls, 50))  # Warm up connections
+        report[name] = {
+            **cold_start(name, url, args.runs),
+            **call_overhead(client, args.calls),
+        }
+    server.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Record a sanitized shape of each request for offline replay (see replay.py).
+# Records never contain bodies or tokens, only sizes and digests of them.
+capture_enabled = os.getenv("DKMS_CAPTURE", "false").lower() == "true"
+sample_rate = float(os.getenv("DKMS_CAPTURE_SAMPLE_RATE", "1"))
+# Append records to this file as JSON lines instead of logging them
+capture_file = os.getenv("DKMS_CAPTURE_FILE", None)
+
+file_lock = threading.Lock()
+invocations = 0
+
+
+def captured(fn):
+    """Capture the shape of invocations of a Lambda handler when enabled."""
+    if not capture_enabled:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(event, context):
+        global invocations
+        invocations += 1
+        cold = invocations == 1
+        if random.random() >= sample_rate:
+            return fn(event, context)
+
+        started_at = time.time()
+        start = time.perf_counter()
+        response = fn(event, context)
+        duration_ms = (time.perf_counter() - start) * 1000
+        write(capture_record(event, response, started_at, duration_ms, cold))
+        return response
+
+    return wrapper
+
+
+def capture_record(
+    event: dict, response: dict, started_at: float, duration_ms: float, cold: bool
+) -> dict:
+    """Return the sanitized shape of a request and its response."""
+    path = event.get("rawPath", "")
+    if path.startswith("/jobs/"):
+        path = "/jobs/{job_id}"
+    auth_header = (event.get("headers") or {}).get("authorization", "")
+    body = event.get("body") or ""
+
+    ciphertext_digest = None
+    if path == "/decrypt":
+        try:
+            ciphertext_digest = digest(json.loads(body).get("ciphertext"))
+        except (ValueError, AttributeError):
+            pass
+
+    error_code = None
+    try:
+        error_code = json.loads(response.get("body", "{}")).get("error_code") or None
+    except ValueError:
+        pass
+
+    return {
+        "message": "capture",
+        "ts": round(started_at, 6),
+        "method": event.get("requestContext", {}).get("http", {}).get("method"),
+        "path": path,
+        "status": response.get("statusCode"),
+        "error_code": error_code,
+        "duration_ms": round(duration_ms, 3),
+        "cold": cold,
+        "body_bytes": len(body),
+        "token_digest": digest(auth_header.split("Bearer ")[-1] or None),
+        "ciphertext_digest": ciphertext_digest,
+    }
+
+
+def digest(value):
+    """Return a short, stable digest of a value, or None."""
+    if not isinstance(value, str) or not value:
+        return None
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+def write(record: dict) -> None:
+    if capture_file is None:
+        logger.info(json.dumps(record))  # JSON so records can be pulled from logs
+        return
+    with file_lock:
+        with open(capture_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
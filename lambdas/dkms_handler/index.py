@@ -1,23 +1,96 @@
 import base64
-import boto3
+import http.client
 import json
 import jwt
 import logging
+import math
 import os
+import random
+import time
 import traceback
+import urllib.parse
 import urllib.request
 from http import HTTPStatus
 
+import capture
+import jobs
+import keyrouting
+import metrics
+import profiling
+import ratelimit
+import sigv4_kms
+import tracing
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 kms_key_id = os.getenv("DKMS_KMS_KEY_ID", None)
 assert kms_key_id is not None, "DKMS_KMS_KEY_ID environment variable must be set"
-kms_client = boto3.client("kms")
+# Size the connection pool for the number of requests served concurrently,
+# which is one in Lambda but many in the long-running server.
+kms_max_pool_connections = int(os.getenv("DKMS_KMS_MAX_POOL_CONNECTIONS", "10"))
+# KMS calls are retried by kms_call rather than inside the client, so that
+# every attempt is counted in /metrics and traced.
+kms_max_attempts = int(os.getenv("DKMS_KMS_MAX_ATTEMPTS", "3"))
+if os.getenv("DKMS_KMS_CLIENT", "boto3") == "sigv4":
+    kms_client = sigv4_kms.KMSClient(
+        endpoint_url=os.getenv("DKMS_KMS_ENDPOINT", None),
+        max_pool_connections=kms_max_pool_connections,
+        max_attempts=1,
+    )
+    # For the key routing map, if it is read from SSM
+    ssm_client = sigv4_kms.SSMClient(max_pool_connections=1)
+    # Errors the client raises before calling KMS, for input KMS would reject
+    kms_input_errors = (ValueError, TypeError)
+    kms_connection_errors = (http.client.HTTPException, OSError)
+else:
+    # Imported here so that boto3 stays off the cold start path with sigv4
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+
+    kms_client = boto3.client(
+        "kms",
+        endpoint_url=os.getenv("DKMS_KMS_ENDPOINT", None),
+        config=botocore.config.Config(
+            max_pool_connections=kms_max_pool_connections,
+            retries={"total_max_attempts": 1},
+        ),
+    )
+    ssm_client = None
+    kms_input_errors = (
+        ValueError,
+        TypeError,
+        botocore.exceptions.ParamValidationError,
+    )
+    kms_connection_errors = (
+        botocore.exceptions.ConnectionError,
+        botocore.exceptions.HTTPClientError,
+    )
 
 jwks_url = os.getenv("JWKS_URL", None)
 assert jwks_url is not None, "JWKS_URL environment variable must be set"
-jwks_client = jwt.PyJWKClient(jwks_url)
+
+
+class JWKSClient(jwt.PyJWKClient):
+    """Fetch JWT signing keys, recording each fetch of the JWKS endpoint."""
+
+    fetched_at = None
+    kids = []
+
+    def fetch_data(self):
+        metrics.registry.increment("jwks.fetches")
+        with metrics.registry.timer("phase.jwks_fetch"), tracing.span(
+            "jwks.refresh", kind="client", **{"http.url": self.uri}
+        ):
+            data = super().fetch_data()
+        self.fetched_at = time.time()
+        if isinstance(data, dict):
+            self.kids = sorted(k["kid"] for k in data.get("keys", []) if "kid" in k)
+        return data
+
+
+jwks_client = JWKSClient(jwks_url)
 
 cors_allow_origins = os.getenv("CORS_ALLOW_ORIGINS", None)
 assert (
@@ -32,50 +105,181 @@ cors_headers = {
 }
 
 
+# Optional bulk job API. Disabled unless a job store and queue are configured.
+job_backend = jobs.backend_from_env()
+job_chunk_size = int(os.getenv("DKMS_JOB_CHUNK_SIZE", "100"))
+job_max_items = int(os.getenv("DKMS_JOB_MAX_ITEMS", "10000"))
+job_kms_max_attempts = int(os.getenv("DKMS_JOB_KMS_MAX_ATTEMPTS", "5"))
+job_rate_limiter = jobs.RateLimiter(float(os.getenv("DKMS_JOB_KMS_RATE", "50")))
+job_tenant_max_wait = float(os.getenv("DKMS_JOB_TENANT_MAX_WAIT", "10"))
+
+# Optional per-tenant rate limiting. Disabled unless DKMS_TENANT_RATE is set.
+tenant_rate_limiter = ratelimit.limiter_from_env()
+tenant_claim = os.getenv("DKMS_TENANT_CLAIM", "ewi")
+
+# Optional per-tenant KMS keys, keyed by the same tenant claim. Tenants that
+# are not in the map, or all of them when no map is configured, use
+# DKMS_KMS_KEY_ID.
+key_router = keyrouting.router_from_env(kms_client, kms_key_id, ssm_client)
+
+# Optional runtime metrics endpoint. Disabled unless an admin claim is configured.
+metrics_admin_claim = os.getenv("DKMS_METRICS_ADMIN_CLAIM", None)
+
+KMS_THROTTLING_ERROR_CODES = {"ThrottlingException"}
+KMS_RETRYABLE_ERROR_CODES = KMS_THROTTLING_ERROR_CODES | {
+    "KMSInternalException",
+    "DependencyTimeoutException",
+}
+JOB_OPERATIONS = {"encrypt", "decrypt"}
+ROUTES = {"/healthz", "/encrypt", "/decrypt", "/jobs", "/metrics"}
+
+
 class AuthenticationError(Exception):
     """Raised when authentication fails."""
 
     pass
 
 
+@profiling.profiled
+@capture.captured
+@tracing.traced
 def handler(event, context) -> dict:
     """Process an API Gateway event and return a response."""
 
     log_event = event.copy()
     log_event["body"] = "omitted"  # Do not log potentially sensitive data
     logger.info(log_event)
-    try:
-        return router(event)
-    except AuthenticationError as e:
-        return return_handler(
-            message="Access Denied",
-            status=HTTPStatus.UNAUTHORIZED,
-            error_code="ACCESS_DENIED",
-        )
-    except Exception as e:
-        logger.info(traceback.format_exc())
-        return return_handler(
-            message="an unknown error occurred",
-            status=HTTPStatus.INTERNAL_SERVER_ERROR,
-            error_code="UNKNOWN_ERROR",
-        )
+    metrics.registry.increment("invocations")
+    with metrics.registry.timer(f"route.{route_name(event)}"):
+        try:
+            return router(event)
+        except AuthenticationError as e:
+            return return_handler(
+                message="Access Denied",
+                status=HTTPStatus.UNAUTHORIZED,
+                error_code="ACCESS_DENIED",
+            )
+        except keyrouting.KeyUnavailableError as e:
+            return return_handler(
+                message="the key for this tenant is unavailable",
+                status=HTTPStatus.FORBIDDEN,
+                error_code="KEY_UNAVAILABLE",
+            )
+        except ratelimit.RateLimitedError as e:
+            response = return_handler(
+                message="rate limit exceeded",
+                status=HTTPStatus.TOO_MANY_REQUESTS,
+                error_code="RATE_LIMITED",
+            )
+            response["headers"]["Retry-After"] = str(math.ceil(e.retry_after))
+            return response
+        except Exception as e:
+            logger.info(traceback.format_exc())
+            return return_handler(
+                message="an unknown error occurred",
+                status=HTTPStatus.INTERNAL_SERVER_ERROR,
+                error_code="UNKNOWN_ERROR",
+            )
+
+
+@profiling.profiled
+def job_worker_handler(event, context) -> dict:
+    """Process bulk job chunks delivered by SQS.
+
+    Failed chunks are reported back as batch item failures so that SQS
+    redelivers them without replaying the chunks that succeeded.
+    """
+    store, _ = job_backend
+    failures = []
+    for record in event["Records"]:
+        message = json.loads(record["body"])
+        try:
+            jobs.process_chunk(
+                store, message["job_id"], message["chunk"], process_job_item
+            )
+        except Exception:
+            logger.info(traceback.format_exc())
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}
+
+
+def job_dead_letter_handler(event, context) -> dict:
+    """Mark bulk job chunks that SQS gave up redelivering as failed."""
+    store, _ = job_backend
+    failures = []
+    for record in event["Records"]:
+        message = json.loads(record["body"])
+        logger.info({"message": "job chunk dead-lettered", **message})
+        try:
+            jobs.fail_chunk(store, message["job_id"], message["chunk"])
+        except Exception:
+            logger.info(traceback.format_exc())
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}
 
 
 def authenticate(event) -> dict:
     """Authenticate the request."""
+    payload = verify_token(event)
+    assert payload.get("ewi"), "No ewi provided in JWT"
+    return payload
+
+
+def admit(event) -> dict:
+    """Authenticate the request and apply the caller's tenant rate limit."""
+    payload = authenticate(event)
+    if tenant_rate_limiter is not None:
+        tenant_rate_limiter.check(tenant_of(payload))
+    return payload
+
+
+def tenant_of(payload: dict) -> str:
+    """Return the tenant a verified token belongs to."""
+    return str(payload.get(tenant_claim) or payload["ewi"])
+
+
+def tenant_kms_key(tenant: str) -> str:
+    """Return the KMS key to use for a tenant."""
+    if key_router is None:
+        return kms_key_id
+    return key_router.resolve(tenant) or kms_key_id
+
+
+def authenticate_admin(event) -> dict:
+    """Authenticate a request for an admin-only route."""
+    payload = verify_token(event)
+    if not payload.get(metrics_admin_claim):
+        raise AuthenticationError(f"No {metrics_admin_claim} claim provided in JWT")
+    return payload
+
+
+def verify_token(event) -> dict:
+    """Verify the bearer token of the request and return its payload."""
     auth_header = event["headers"].get("authorization", None)
     logger.info(auth_header)
     if not auth_header:
         raise AuthenticationError("No Authorization header provided")
 
-    token = auth_header.split("Bearer ")[1]
-    signing_key = jwks_client.get_signing_key_from_jwt(token)
-    payload = jwt.decode(token, signing_key.key, algorithms=["RS256"])
+    with metrics.registry.timer("phase.authenticate"), tracing.span("authenticate"):
+        metrics.registry.increment("jwks.lookups")
+        token = auth_header.split("Bearer ")[1]
+        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        payload = jwt.decode(token, signing_key.key, algorithms=["RS256"])
     logger.info(payload)
-    assert payload.get("ewi"), "No ewi provided in JWT"
     return payload
 
 
+def route_name(event) -> str:
+    """Return the route of a request for metrics, collapsing path parameters."""
+    http_method = event.get("requestContext", {}).get("http", {}).get("method")
+    path = event.get("rawPath", "")
+    if path.startswith("/jobs/"):
+        path = "/jobs/{job_id}"
+    elif path not in ROUTES:
+        path = "other"
+    return f"{http_method} {path}"
+
+
 def router(event) -> dict:
     """Route the API request to the correct handler."""
     http_method = event["requestContext"]["http"]["method"]
@@ -86,19 +290,36 @@ def router(event) -> dict:
     elif http_method == "GET" and path == "/healthz":
         return return_handler(status=HTTPStatus.OK)
     elif http_method == "POST" and path == "/encrypt":
-        payload = authenticate(event)
+        payload = admit(event)
         return encrypt(
             event["body"],
-            kms_key_id,
+            tenant_kms_key(tenant_of(payload)),
             encryption_context={"ewi": payload.get("ewi")},
         )
     elif http_method == "POST" and path == "/decrypt":
-        payload = authenticate(event)
+        payload = admit(event)
         return decrypt(
             event["body"],
-            kms_key_id,
+            tenant_kms_key(tenant_of(payload)),
             encryption_context={"ewi": payload.get("ewi")},
+            tenant=tenant_of(payload),
         )
+    elif http_method == "POST" and path == "/jobs" and job_backend is not None:
+        payload = admit(event)
+        return submit_job(
+            event["body"], ewi=payload.get("ewi"), tenant=tenant_of(payload)
+        )
+    elif http_method == "GET" and path.startswith("/jobs/") and job_backend is not None:
+        payload = authenticate(event)
+        query = urllib.parse.parse_qs(event.get("rawQueryString") or "")
+        return get_job(
+            path[len("/jobs/") :],
+            ewi=payload.get("ewi"),
+            chunk=query.get("chunk", [None])[0],
+        )
+    elif http_method == "GET" and path == "/metrics" and metrics_admin_claim:
+        authenticate_admin(event)
+        return return_handler(status=HTTPStatus.OK, data=metrics.registry.snapshot())
 
     return return_handler(
         message=f"path {path} not found",
@@ -128,16 +349,15 @@ def encrypt(body: str, kms_key_id: str, encryption_context: dict) -> dict:
             error_code="INVALID_INPUT",
         )
 
-    response = kms_client.encrypt(
-        KeyId=kms_key_id,
-        EncryptionContext=encryption_context,
-        Plaintext=parsed_body.get("plaintext"),
+    encrypted_response = kms_encrypt(
+        parsed_body.get("plaintext"), kms_key_id, encryption_context
     )
-    encrypted_response = base64.b64encode(response["CiphertextBlob"]).decode("utf-8")
     return return_handler(status=HTTPStatus.OK, data={"ciphertext": encrypted_response})
 
 
-def decrypt(body: str, kms_key_id: str, encryption_context: dict) -> dict:
+def decrypt(
+    body: str, kms_key_id: str, encryption_context: dict, tenant: str = None
+) -> dict:
     """Handle a decrypt request."""
     if body is None:
         return return_handler(
@@ -158,14 +378,241 @@ def decrypt(body: str, kms_key_id: str, encryption_context: dict) -> dict:
             error_code="INVALID_INPUT",
         )
 
-    decoded_payload = base64.b64decode(parsed_body["ciphertext"])
-    response = kms_client.decrypt(
+    decrypted_data = kms_decrypt(
+        parsed_body["ciphertext"], kms_key_id, encryption_context, tenant=tenant
+    )
+    return return_handler(status=HTTPStatus.OK, data={"plaintext": decrypted_data})
+
+
+def submit_job(body: str, ewi: str, tenant: str = None) -> dict:
+    """Handle a bulk job submission."""
+    if body is None:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST, message="no body", error_code="INVALID_INPUT"
+        )
+    try:
+        parsed_body = json.loads(body)
+    except json.decoder.JSONDecodeError:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message="invalid json in body",
+            error_code="INVALID_INPUT",
+        )
+    if parsed_body.get("operation") not in JOB_OPERATIONS:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message="operation must be one of encrypt, decrypt",
+            error_code="INVALID_INPUT",
+        )
+    items = parsed_body.get("items")
+    if not isinstance(items, list) or not items:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message="no items provided",
+            error_code="INVALID_INPUT",
+        )
+    if not all(isinstance(item, str) and item for item in items):
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message="items must be non-empty strings",
+            error_code="INVALID_INPUT",
+        )
+    if len(items) > job_max_items:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message=f"at most {job_max_items} items may be submitted per job",
+            error_code="INVALID_INPUT",
+        )
+
+    store, queue = job_backend
+    manifest = jobs.submit_job(
+        store, queue, ewi, parsed_body["operation"], items, job_chunk_size, tenant
+    )
+    return return_handler(
+        status=HTTPStatus.ACCEPTED,
+        data={
+            "job_id": manifest["job_id"],
+            "status": "PENDING",
+            "item_count": manifest["item_count"],
+            "chunk_count": manifest["chunk_count"],
+        },
+    )
+
+
+def get_job(job_id: str, ewi: str, chunk: str = None) -> dict:
+    """Handle a bulk job status request, with the results of `chunk` if given."""
+    store, _ = job_backend
+    try:
+        job = jobs.get_job(store, job_id, ewi, int(chunk) if chunk else None)
+    except jobs.JobNotFoundError:
+        return return_handler(
+            message=f"job {job_id} not found",
+            status=HTTPStatus.NOT_FOUND,
+            error_code="JOB_NOT_FOUND",
+        )
+    except ValueError:
+        return return_handler(
+            status=HTTPStatus.BAD_REQUEST,
+            message="chunk must be the index of one of the job's chunks",
+            error_code="INVALID_INPUT",
+        )
+    return return_handler(status=HTTPStatus.OK, data=job)
+
+
+def process_job_item(operation: str, item: str, ewi: str, tenant: str = None) -> dict:
+    """Encrypt or decrypt a single bulk job item at the job's KMS rate.
+
+    Each item also takes a token from the tenant's rate limit, so that bulk
+    jobs share the tenant's budget with its API requests.
+    """
+    encryption_context = {"ewi": ewi}
+    tenant = tenant or ewi
+    admit_job_item(tenant)
+    job_rate_limiter.acquire()
+    try:
+        key_id = tenant_kms_key(tenant)
+        if operation == "encrypt":
+            return {
+                "ciphertext": kms_encrypt(
+                    item, key_id, encryption_context, job_kms_max_attempts
+                )
+            }
+        return {
+            "plaintext": kms_decrypt(
+                item, key_id, encryption_context, job_kms_max_attempts, tenant
+            )
+        }
+    except kms_input_errors:
+        # Rejected before reaching KMS, so redelivering would fail the same way
+        return {"error_code": "INVALID_INPUT"}
+    except keyrouting.KeyUnavailableError:
+        return {"error_code": "KEY_UNAVAILABLE"}
+    except Exception as e:
+        error_code = kms_error_code(e)
+        if error_code is None or kms_retryable(e):
+            raise  # Let SQS redeliver the chunk
+        return {"error_code": error_code}
+
+
+def admit_job_item(tenant: str) -> None:
+    """Wait for a token from the tenant's rate limit for a bulk job item.
+
+    Raises RateLimitedError if that would take longer than
+    `job_tenant_max_wait`, failing the chunk so that SQS redelivers it later.
+    """
+    if tenant_rate_limiter is None:
+        return
+    while True:
+        try:
+            return tenant_rate_limiter.check(tenant)
+        except ratelimit.RateLimitedError as e:
+            if e.retry_after > job_tenant_max_wait:
+                raise
+            time.sleep(e.retry_after)
+
+
+def kms_encrypt(
+    plaintext: str,
+    kms_key_id: str,
+    encryption_context: dict,
+    max_attempts: int = None,
+) -> str:
+    """Encrypt plaintext with KMS and return the base64 encoded ciphertext."""
+    response = kms_call(
+        "encrypt",
+        max_attempts,
         KeyId=kms_key_id,
         EncryptionContext=encryption_context,
-        CiphertextBlob=decoded_payload,
+        Plaintext=plaintext,
+    )
+    return base64.b64encode(response["CiphertextBlob"]).decode("utf-8")
+
+
+def kms_decrypt(
+    ciphertext: str,
+    key_id: str,
+    encryption_context: dict,
+    max_attempts: int = None,
+    tenant: str = None,
+) -> str:
+    """Decrypt base64 encoded ciphertext with KMS and return the plaintext.
+
+    With per-tenant keys, a ciphertext may be under the default key or a key
+    the tenant was previously routed to. Symmetric ciphertexts record their
+    key, so these are decrypted with it as long as the tenant may use it.
+    """
+    ciphertext_blob = base64.b64decode(ciphertext)
+    params = {
+        "EncryptionContext": encryption_context,
+        "CiphertextBlob": ciphertext_blob,
+    }
+    try:
+        response = kms_call("decrypt", max_attempts, KeyId=key_id, **params)
+    except Exception as e:
+        if key_router is None or kms_error_code(e) != "IncorrectKeyException":
+            raise
+        response = kms_call("decrypt", max_attempts, **params)
+        if not tenant_may_decrypt_with(tenant, response["KeyId"]):
+            raise keyrouting.KeyUnavailableError(
+                tenant, response["KeyId"], "not routed to this tenant"
+            )
+        metrics.registry.increment("keyrouting.fallback_decrypts")
+    return response["Plaintext"].decode("utf-8")
+
+
+def tenant_may_decrypt_with(tenant: str, key_arn: str) -> bool:
+    """Return whether a tenant's ciphertexts may be under the given key."""
+    allowed = {kms_key_id} | key_router.decrypt_keys(tenant)
+    return any(key_arn == key or key_arn.endswith(f"/{key}") for key in allowed)
+
+
+def kms_call(operation: str, max_attempts: int = None, **kwargs) -> dict:
+    """Call a KMS operation, retrying throttled and transient failures.
+
+    Makes up to `max_attempts` attempts, DKMS_KMS_MAX_ATTEMPTS by default.
+    """
+    max_attempts = max_attempts or kms_max_attempts
+    with tracing.span(f"kms.{operation}") as call_span:
+        for attempt in range(1, max_attempts + 1):
+            metrics.registry.increment(f"kms.calls.{operation}")
+            call_span.set("attempts", attempt)
+            if attempt > 1:
+                metrics.registry.increment("kms.retries")
+            try:
+                with metrics.registry.timer(f"phase.kms.{operation}"), tracing.span(
+                    "KMS", kind="client", attempt=attempt
+                ) as attempt_span:
+                    attempt_span.set("aws.operation", operation)
+                    try:
+                        return getattr(kms_client, operation)(**kwargs)
+                    except Exception as e:
+                        attempt_span.set("aws.error_code", kms_error_code(e))
+                        raise
+            except Exception as e:
+                throttled = kms_error_code(e) in KMS_THROTTLING_ERROR_CODES
+                metrics.registry.increment(
+                    "kms.throttles" if throttled else "kms.errors"
+                )
+                if not kms_retryable(e) or attempt == max_attempts:
+                    raise
+                time.sleep(min(0.1 * 2**attempt, 5.0) * random.uniform(0.5, 1.0))
+
+
+def kms_error_code(e: Exception) -> str:
+    """Return the AWS error code of a failed KMS call, if there is one."""
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+def kms_retryable(e: Exception) -> bool:
+    """Return whether a failed KMS call may succeed if it is retried."""
+    status = (
+        getattr(e, "response", {}).get("ResponseMetadata", {}).get("HTTPStatusCode")
+    )
+    return (
+        kms_error_code(e) in KMS_RETRYABLE_ERROR_CODES
+        or (status or 0) >= 500
+        or isinstance(e, kms_connection_errors)
     )
-    decrypted_data = response["Plaintext"].decode("utf-8")
-    return return_handler(status=HTTPStatus.OK, data={"plaintext": decrypted_data})
 
 
 def return_options_handler() -> dict:
@@ -199,15 +646,44 @@ def return_handler(
             "statusCode": status.value,
         }
     )
-    return {
-        "statusCode": status.value,
-        "headers": {"Content-Type": "application/json", **cors_headers},
-        "body": json.dumps(
+    with metrics.registry.timer("phase.serialize"), tracing.span("serialize"):
+        body = json.dumps(
             {
                 "data": data,
                 "error_code": error_code,
                 "message": message,
                 "status": status.name,
             }
+        )
+    return {
+        "statusCode": status.value,
+        "headers": {"Content-Type": "application/json", **cors_headers},
+        "body": body,
+    }
+
+
+def jwks_cache_stats() -> dict:
+    """Report the age, key ids and hit ratio of the JWKS cache."""
+    lookups = metrics.registry.counters.get("jwks.lookups", 0)
+    fetches = metrics.registry.counters.get("jwks.fetches", 0)
+    hits = max(lookups - fetches, 0)
+    return {
+        "size": len(jwks_client.kids),
+        "kids": jwks_client.kids,
+        "age_seconds": (
+            round(time.time() - jwks_client.fetched_at, 3)
+            if jwks_client.fetched_at is not None
+            else None
         ),
+        "hits": hits,
+        "misses": fetches,
+        "hit_ratio": round(hits / lookups, 4) if lookups else None,
     }
+
+
+metrics.registry.register_cache("jwks", jwks_cache_stats)
+if tenant_rate_limiter is not None:
+    metrics.registry.register_cache("tenant_rate_limits", tenant_rate_limiter.stats)
+if key_router is not None:
+    metrics.registry.register_cache("kms_keys", key_router.stats)
+metrics.registry.mark_ready()
@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class JobNotFoundError(Exception):
+    """Raised when a job does not exist or belongs to another caller."""
+
+    pass
+
+
+class LocalJobStore:
+    """Store job documents as JSON files under a local directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def put_json(self, key: str, value) -> None:
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(value, f)
+
+    def get_json(self, key: str):
+        try:
+            with open(os.path.join(self.root, key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def count_keys(self, prefix: str) -> int:
+        try:
+            return len(os.listdir(os.path.join(self.root, prefix)))
+        except FileNotFoundError:
+            return 0
+
+
+class S3JobStore:
+    """Store job documents as JSON objects in an S3 bucket."""
+
+    def __init__(self, bucket: str):
+        import boto3
+
+        self.bucket = bucket
+        self.client = boto3.client("s3")
+
+    def put_json(self, key: str, value) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(value).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def get_json(self, key: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def count_keys(self, prefix: str) -> int:
+        paginator = self.client.get_paginator("list_objects_v2")
+        return sum(
+            page.get("KeyCount", 0)
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{prefix}/")
+        )
+
+
+class InMemoryJobQueue:
+    """Hold chunk messages in memory until they are drained."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, messages: list) -> None:
+        self.messages.extend(messages)
+
+    def as_sqs_event(self) -> dict:
+        """Drain the queue into an SQS-shaped Lambda event."""
+        records = [
+            {"messageId": str(uuid.uuid4()), "body": json.dumps(message)}
+            for message in self.messages
+        ]
+        self.messages = []
+        return {"Records": records}
+
+
+class SQSJobQueue:
+    """Send chunk messages to an SQS queue."""
+
+    def __init__(self, queue_url: str):
+        import boto3
+
+        self.queue_url = queue_url
+        self.client = boto3.client("sqs")
+
+    def send(self, messages: list) -> None:
+        # SQS accepts at most 10 entries per batch
+        for start in range(0, len(messages), 10):
+            entries = [
+                {"Id": str(i), "MessageBody": json.dumps(message)}
+                for i, message in enumerate(messages[start : start + 10])
+            ]
+            response = self.client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries
+            )
+            if response.get("Failed"):
+                raise RuntimeError(f"failed to enqueue chunks: {response['Failed']}")
+
+
+class RateLimiter:
+    """Pace calls so that at most `rate` calls per second are made."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def backend_from_env():
+    """Return the (store, queue) pair configured in the environment, if any."""
+    bucket = os.getenv("DKMS_JOB_BUCKET", None)
+    queue_url = os.getenv("DKMS_JOB_QUEUE_URL", None)
+    if bucket is not None and queue_url is not None:
+        return S3JobStore(bucket), SQSJobQueue(queue_url)
+
+    local_dir = os.getenv("DKMS_JOB_LOCAL_DIR", None)
+    if local_dir is not None:
+        return LocalJobStore(local_dir), InMemoryJobQueue()
+
+    return None
+
+
+def submit_job(
+    store,
+    queue,
+    ewi: str,
+    operation: str,
+    items: list,
+    chunk_size: int,
+    tenant: str = None,
+) -> dict:
+    """Store the job input in chunks and enqueue one message per chunk."""
+    job_id = str(uuid.uuid4())
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+    for index, chunk in enumerate(chunks):
+        store.put_json(f"jobs/{job_id}/input/{index}.json", chunk)
+    manifest = {
+        "job_id": job_id,
+        "ewi": ewi,
+        "tenant": tenant,
+        "operation": operation,
+        "item_count": len(items),
+        "chunk_size": chunk_size,
+        "chunk_count": len(chunks),
+        "created_at": int(time.time()),
+    }
+    store.put_json(f"jobs/{job_id}/manifest.json", manifest)
+    queue.send([{"job_id": job_id, "chunk": index} for index in range(len(chunks))])
+    return manifest
+
+
+def get_job(store, job_id: str, ewi: str, chunk: int = None) -> dict:
+    """Return the status of a job, and the results of one chunk if requested.
+
+    Results are returned a chunk at a time so that responses stay within the
+    Lambda payload limit however many items the job has. A job is FAILED once
+    any of its chunks has been dead-lettered, as it can then never complete.
+    """
+    manifest = store.get_json(f"jobs/{job_id}/manifest.json")
+    if manifest is None or manifest["ewi"] != ewi:
+        raise JobNotFoundError(job_id)
+    if chunk is not None and not 0 <= chunk < manifest["chunk_count"]:
+        raise ValueError(f"job {job_id} has no chunk {chunk}")
+
+    chunks_complete = store.count_keys(f"jobs/{job_id}/results")
+    chunks_failed = store.count_keys(f"jobs/{job_id}/failed")
+    job = {
+        "job_id": job_id,
+        "operation": manifest["operation"],
+        "item_count": manifest["item_count"],
+        "chunk_size": manifest.get("chunk_size"),
+        "chunk_count": manifest["chunk_count"],
+        "chunks_complete": chunks_complete,
+        "chunks_failed": chunks_failed,
+        "status": "PENDING",
+    }
+    if chunks_failed:
+        job["status"] = "FAILED"
+    elif chunks_complete >= manifest["chunk_count"]:
+        job["status"] = "COMPLETE"
+
+    if chunk is not None:
+        results = store.get_json(f"jobs/{job_id}/results/{chunk}.json")
+        job["chunk"] = chunk
+        job["chunk_status"] = "COMPLETE" if results is not None else "PENDING"
+        if results is None and store.get_json(f"jobs/{job_id}/failed/{chunk}.json"):
+            job["chunk_status"] = "FAILED"
+        job["results"] = results
+    return job
+
+
+def process_chunk(store, job_id: str, chunk: int, handle_item) -> None:
+    """Run `handle_item(operation, item, ewi, tenant)` on a chunk and store results.
+
+    Results are only written once the whole chunk succeeds, so a chunk that
+    raises part way through can be redelivered and reprocessed from scratch.
+    """
+    manifest = store.get_json(f"jobs/{job_id}/manifest.json")
+    if manifest is None:
+        raise JobNotFoundError(job_id)
+    if store.get_json(f"jobs/{job_id}/results/{chunk}.json") is not None:
+        return  # Already processed by an earlier delivery
+
+    items = store.get_json(f"jobs/{job_id}/input/{chunk}.json")
+    results = [
+        handle_item(
+            manifest["operation"], item, manifest["ewi"], manifest.get("tenant")
+        )
+        for item in items
+    ]
+    store.put_json(f"jobs/{job_id}/results/{chunk}.json", results)
+
+
+def fail_chunk(store, job_id: str, chunk: int) -> None:
+    """Record that a chunk was dead-lettered after exhausting its deliveries."""
+    if store.get_json(f"jobs/{job_id}/manifest.json") is None:
+        return  # Expired along with the rest of the job
+    if store.get_json(f"jobs/{job_id}/results/{chunk}.json") is not None:
+        return  # Completed by a delivery that raced the dead-lettering
+    store.put_json(
+        f"jobs/{job_id}/failed/{chunk}.json",
+        {"chunk": chunk, "failed_at": int(time.time())},
+    )
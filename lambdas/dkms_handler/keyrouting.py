@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger()
+
+
+class KeyUnavailableError(Exception):
+    """Raised when a tenant's KMS key is disabled or cannot encrypt data."""
+
+    def __init__(self, tenant: str, key_id: str, reason: str):
+        super().__init__(f"key {key_id} for tenant {tenant} is {reason}")
+        self.tenant = tenant
+        self.key_id = key_id
+        self.reason = reason
+
+
+class FileRouteSource:
+    """Read the tenant to key map from a JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        with open(self.path) as f:
+            return json.load(f)
+
+
+class ParameterRouteSource:
+    """Read the tenant to key map from an SSM parameter holding a JSON document.
+
+    `client` is any client with boto3's `get_parameter`, such as
+    `sigv4_kms.SSMClient`, and defaults to a boto3 client.
+    """
+
+    def __init__(self, name: str, client=None):
+        if client is None:
+            import boto3
+
+            client = boto3.client("ssm")
+        self.name = name
+        self.client = client
+
+    def load(self) -> dict:
+        response = self.client.get_parameter(Name=self.name, WithDecryption=True)
+        return json.loads(response["Parameter"]["Value"])
+
+
+class KeyRouter:
+    """Route tenants to their own KMS keys, caching each key's metadata.
+
+    The map is loaded when the router is created and then refreshed in a
+    background thread once it is older than `refresh_interval`, re-describing
+    keys whose metadata is older than `metadata_ttl`. Requests only read the
+    cached map and metadata, so routing adds no calls to the request path.
+    Keys are described concurrently, so loading the map costs about one
+    DescribeKey round trip however many keys it has. If the map cannot be
+    loaded when the router is created, every tenant uses the default key
+    until a background refresh succeeds.
+
+    A tenant maps to a key id or alias, or to a list of them: the first is
+    used to encrypt, and the others are only accepted when decrypting, so
+    that keys can be rotated without stranding existing ciphertexts.
+    """
+
+    # Seconds between attempts to load a map after a failed attempt
+    retry_interval = 5
+    # Most DescribeKey calls made at once
+    max_describes = 16
+
+    def __init__(
+        self,
+        source,
+        kms_client,
+        refresh_interval: float = 60,
+        metadata_ttl: float = 300,
+        default_key_id: str = None,
+    ):
+        self.source = source
+        self.kms_client = kms_client
+        self.default_key_id = default_key_id
+        self.refresh_interval = refresh_interval
+        self.metadata_ttl = metadata_ttl
+        self.routes = {}
+        self.keys = {}
+        self.loaded_at = None
+        self.failed_at = None
+        self.refresh_lock = threading.Lock()
+        try:
+            self.refresh()
+        except Exception:
+            # Serve with the default key rather than fail the container
+            logger.exception("failed to load key routes")
+            metrics.registry.increment("keyrouting.refresh_errors")
+            self.failed_at = time.time()
+
+    def resolve(self, tenant: str):
+        """Return the key ARN for a tenant, or None if it uses the default key."""
+        self.refresh_if_stale()
+        key_id = self.routes.get(tenant)
+        if key_id is None:
+            metrics.registry.increment("keyrouting.default")
+            return None
+
+        metrics.registry.increment("keyrouting.routed")
+        key_id = key_id[0]
+        key = self.keys.get(key_id)
+        if key is None:
+            return key_id  # Not described yet; let KMS resolve it
+        if key["enabled"] is False:
+            raise KeyUnavailableError(tenant, key_id, "disabled")
+        if key["spec"] not in (None, "SYMMETRIC_DEFAULT"):
+            raise KeyUnavailableError(tenant, key_id, f"a {key['spec']} key")
+        return key["arn"]
+
+    def refresh(self) -> None:
+        """Reload the map and describe keys that are new or past their TTL."""
+        routes = self.source.load()
+        if not isinstance(routes, dict):
+            raise ValueError("key routes must map tenants to key ids or aliases")
+        routes = {
+            tenant: [key_ids] if isinstance(key_ids, str) else key_ids
+            for tenant, key_ids in routes.items()
+        }
+        if not all(
+            isinstance(key_ids, list)
+            and key_ids
+            and all(isinstance(key_id, str) for key_id in key_ids)
+            for key_ids in routes.values()
+        ):
+            raise ValueError("key routes must map tenants to key ids or aliases")
+
+        now = time.time()
+        key_ids = {key_id for key_ids in routes.values() for key_id in key_ids}
+        if self.default_key_id is not None:
+            key_ids.add(self.default_key_id)
+        keys = {key_id: self.keys.get(key_id) for key_id in key_ids}
+        stale = [
+            key_id
+            for key_id, key in keys.items()
+            if key is None or now - key["fetched_at"] >= self.metadata_ttl
+        ]
+        if stale:
+            with ThreadPoolExecutor(min(len(stale), self.max_describes)) as executor:
+                described = executor.map(
+                    lambda key_id: self.describe(key_id, keys[key_id]), stale
+                )
+                keys.update(zip(stale, described))
+        self.routes, self.keys, self.loaded_at = routes, keys, now
+        self.failed_at = None
+        metrics.registry.increment("keyrouting.refreshes")
+
+    def decrypt_keys(self, tenant: str) -> set:
+        """Return the ids and ARNs of the keys a tenant's ciphertexts may use."""
+        key_ids = self.routes.get(tenant, [])
+        if self.default_key_id is not None:
+            key_ids = key_ids + [self.default_key_id]
+        names = set(key_ids)
+        for key_id in key_ids:
+            key = self.keys.get(key_id)
+            if key is not None:
+                names.add(key["arn"])
+        return names
+
+    def describe(self, key_id: str, previous: dict = None) -> dict:
+        try:
+            metadata = self.kms_client.describe_key(KeyId=key_id)["KeyMetadata"]
+        except Exception:
+            logger.exception(f"failed to describe key {key_id}")
+            metrics.registry.increment("keyrouting.describe_errors")
+            if previous is not None:
+                return previous
+            return {"arn": key_id, "enabled": None, "spec": None, "fetched_at": 0}
+        return {
+            "arn": metadata["Arn"],
+            "enabled": metadata.get("KeyState", "Enabled") == "Enabled",
+            "spec": metadata.get("KeySpec"),
+            "fetched_at": time.time(),
+        }
+
+    def refresh_if_stale(self) -> None:
+        """Start a background refresh if the map is stale and none is running."""
+        now = time.time()
+        if self.loaded_at is not None and now - self.loaded_at < self.refresh_interval:
+            return
+        if self.failed_at is not None and now - self.failed_at < self.retry_interval:
+            return
+        if self.refresh_lock.acquire(blocking=False):
+            threading.Thread(target=self.background_refresh, daemon=True).start()
+
+    def background_refresh(self) -> None:
+        try:
+            self.refresh()
+        except Exception:
+            # Keep routing with the last good map
+            logger.exception("failed to refresh key routes")
+            metrics.registry.increment("keyrouting.refresh_errors")
+            self.failed_at = time.time()
+        finally:
+            self.refresh_lock.release()
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "size": len(self.routes),
+            "age_seconds": (
+                round(now - self.loaded_at, 3) if self.loaded_at is not None else None
+            ),
+            "keys": {
+                key_id: {
+                    "arn": key["arn"],
+                    "enabled": key["enabled"],
+                    "spec": key["spec"],
+                    "age_seconds": round(now - key["fetched_at"], 3),
+                }
+                for key_id, key in self.keys.items()
+            },
+        }
+
+
+def router_from_env(kms_client, default_key_id: str = None, ssm_client=None):
+    """Return the key router configured in the environment, if any."""
+    path = os.getenv("DKMS_KEY_ROUTES_FILE", None)
+    parameter = os.getenv("DKMS_KEY_ROUTES_PARAMETER", None)
+    if path is not None:
+        source = FileRouteSource(path)
+    elif parameter is not None:
+        source = ParameterRouteSource(parameter, ssm_client)
+    else:
+        return None
+
+    return KeyRouter(
+        source,
+        kms_client,
+        refresh_interval=float(os.getenv("DKMS_KEY_ROUTES_REFRESH_SECONDS", "60")),
+        metadata_ttl=float(os.getenv("DKMS_KEY_METADATA_TTL_SECONDS", "300")),
+        default_key_id=default_key_id,
+    )
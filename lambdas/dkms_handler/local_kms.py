@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalKMSError(Exception):
+    """Raised by LocalKMS, shaped like a botocore ClientError."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(f"{code}: {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class LocalKMS:
+    """In-process stand-in for the KMS client used by the handler.
+
+    Ciphertexts are bound to the key id and encryption context like real KMS
+    ciphertexts, so mismatched decrypts fail, but the scheme is only meant for
+    local testing and benchmarking and offers no real protection.
+    """
+
+    def __init__(self, latency_ms: float = 0):
+        self.latency_ms = latency_ms
+        self.secret = os.urandom(32)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def encrypt(self, KeyId, Plaintext, EncryptionContext=None, **kwargs) -> dict:
+        self.record("Encrypt")
+        return {
+            "CiphertextBlob": self.seal(KeyId, Plaintext, EncryptionContext),
+            "KeyId": KeyId,
+        }
+
+    def decrypt(self, CiphertextBlob, EncryptionContext=None, KeyId=None, **kwargs):
+        self.record("Decrypt")
+        key_id, plaintext = self.open(CiphertextBlob, EncryptionContext, KeyId)
+        return {"Plaintext": plaintext, "KeyId": key_id}
+
+    def generate_data_key(
+        self, KeyId, KeySpec="AES_256", NumberOfBytes=None, EncryptionContext=None
+    ) -> dict:
+        self.record("GenerateDataKey")
+        plaintext = os.urandom(NumberOfBytes or (16 if KeySpec == "AES_128" else 32))
+        return {
+            "CiphertextBlob": self.seal(KeyId, plaintext, EncryptionContext),
+            "Plaintext": plaintext,
+            "KeyId": KeyId,
+        }
+
+    def re_encrypt(
+        self,
+        CiphertextBlob,
+        DestinationKeyId,
+        SourceEncryptionContext=None,
+        DestinationEncryptionContext=None,
+        SourceKeyId=None,
+        **kwargs,
+    ) -> dict:
+        self.record("ReEncrypt")
+        key_id, plaintext = self.open(
+            CiphertextBlob, SourceEncryptionContext, SourceKeyId
+        )
+        return {
+            "CiphertextBlob": self.seal(
+                DestinationKeyId, plaintext, DestinationEncryptionContext
+            ),
+            "SourceKeyId": key_id,
+            "KeyId": DestinationKeyId,
+        }
+
+    def describe_key(self, KeyId) -> dict:
+        self.record("DescribeKey")
+        key_id = KeyId.rsplit("/", 1)[-1]
+        return {
+            "KeyMetadata": {
+                "KeyId": key_id,
+                "Arn": f"arn:aws:kms:local:000000000000:key/{key_id}",
+                "KeyState": "Enabled",
+                "KeySpec": "SYMMETRIC_DEFAULT",
+            }
+        }
+
+    def record(self, operation: str) -> None:
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def seal(self, key_id: str, plaintext, encryption_context) -> bytes:
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode("utf-8")
+        header = key_id.encode("utf-8")
+        nonce = os.urandom(16)
+        body = bytes(a ^ b for a, b in zip(plaintext, self.keystream(nonce)))
+        tag = self.tag(header, nonce, body, encryption_context)
+        return len(header).to_bytes(2, "big") + header + nonce + body + tag
+
+    def open(self, blob: bytes, encryption_context, expected_key_id=None):
+        try:
+            header_length = int.from_bytes(blob[:2], "big")
+            header = blob[2 : 2 + header_length]
+            nonce = blob[2 + header_length : 18 + header_length]
+            body, tag = blob[18 + header_length : -32], blob[-32:]
+            key_id = header.decode("utf-8")
+        except (IndexError, UnicodeDecodeError):
+            raise LocalKMSError("InvalidCiphertextException", "malformed ciphertext")
+        if len(tag) != 32 or not hmac.compare_digest(
+            tag, self.tag(header, nonce, body, encryption_context)
+        ):
+            raise LocalKMSError("InvalidCiphertextException", "invalid ciphertext")
+        if expected_key_id is not None and expected_key_id != key_id:
+            raise LocalKMSError("IncorrectKeyException", "incorrect key")
+        return key_id, bytes(a ^ b for a, b in zip(body, self.keystream(nonce)))
+
+    def keystream(self, nonce: bytes):
+        for counter in range(2**32):
+            yield from hashlib.sha256(
+                self.secret + nonce + counter.to_bytes(4, "big")
+            ).digest()
+
+    def tag(self, header: bytes, nonce: bytes, body: bytes, encryption_context):
+        context = json.dumps(encryption_context or {}, sort_keys=True).encode("utf-8")
+        return hmac.new(
+            self.secret, header + nonce + body + context, hashlib.sha256
+        ).digest()
+
+
+def serve_http(kms: LocalKMS, host: str = "127.0.0.1", port: int = 0):
+    """Serve a LocalKMS over the KMS JSON protocol in a background thread.
+
+    Returns the server and its endpoint URL. Requests must carry a SigV4
+    Authorization header, but signatures are not verified.
+    """
+    operations = {
+        "TrentService.Encrypt": kms.encrypt,
+        "TrentService.Decrypt": kms.decrypt,
+        "TrentService.GenerateDataKey": kms.generate_data_key,
+        "TrentService.ReEncrypt": kms.re_encrypt,
+        "TrentService.DescribeKey": kms.describe_key,
+    }
+    blob_fields = {"Plaintext", "CiphertextBlob"}
+
+    class KMSHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep connections alive
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            operation = operations.get(self.headers.get("X-Amz-Target"))
+            if not self.headers.get("Authorization", "").startswith(
+                "AWS4-HMAC-SHA256 "
+            ):
+                return self.reply(400, error("MissingAuthenticationToken", "unsigned"))
+            if operation is None:
+                return self.reply(400, error("UnknownOperationException", "unknown"))
+
+            params = {
+                key: base64.b64decode(value) if key in blob_fields else value
+                for key, value in json.loads(body).items()
+            }
+            try:
+                result = operation(**params)
+            except LocalKMSError as e:
+                return self.reply(400, error(**e.response["Error"]))
+            self.reply(
+                200,
+                {
+                    key: base64.b64encode(value).decode("ascii")
+                    if key in blob_fields
+                    else value
+                    for key, value in result.items()
+                },
+            )
+
+        def reply(self, status: int, data: dict) -> None:
+            payload = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/x-amz-json-1.1")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    def error(Code: str, Message: str) -> dict:
+        return {"__type": Code, "message": Message}
+
+    server = ThreadingHTTPServer((host, port), KMSHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
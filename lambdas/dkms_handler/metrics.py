@@ -0,0 +1,127 @@
+import bisect
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """Count observations into fixed latency buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.sum += value_ms
+        self.max = max(self.max, value_ms)
+
+    def snapshot(self) -> dict:
+        buckets = {
+            f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, self.counts)
+        }
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "sum_ms": round(self.sum, 3),
+            "max_ms": round(self.max, 3),
+            "buckets": buckets,
+        }
+
+
+class Registry:
+    """Hold the runtime metrics of this container (or server process)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.cold_start_ms = None
+        self.counters = {}
+        self.histograms = {}
+        self.caches = {}
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value_ms: float) -> None:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value_ms)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observe the time spent in the block in the `name` histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def register_cache(self, name: str, stats) -> None:
+        """Report the dict returned by `stats()` under caches.<name>."""
+        self.caches[name] = stats
+
+    def mark_ready(self) -> None:
+        """Record how long the process took to become ready to serve."""
+        age = process_age_seconds()
+        if age is not None:
+            self.cold_start_ms = round(age * 1000, 3)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            latency = {
+                name: histogram.snapshot()
+                for name, histogram in sorted(self.histograms.items())
+            }
+        return {
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "invocations": counters.get("invocations", 0),
+            "cold_start_ms": self.cold_start_ms,
+            "counters": counters,
+            "latency_ms": latency,
+            "caches": {name: stats() for name, stats in self.caches.items()},
+            "memory": memory_stats(),
+        }
+
+
+def process_age_seconds():
+    """Return how long ago this process started, if it can be determined."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The process start time is field 22, after the parenthesised name
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def memory_stats() -> dict:
+    """Return the current and peak resident memory of this process."""
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = {"peak_rss_bytes": peak_rss}
+    try:
+        with open("/proc/self/statm") as f:
+            stats["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        pass
+    memory_limit_mb = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "0"))
+    if memory_limit_mb:
+        stats["limit_bytes"] = memory_limit_mb * 1024 * 1024
+    return stats
+
+
+registry = Registry()
@@ -0,0 +1,130 @@
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger()
+
+# Comma separated profilers to run: "cpu" (cProfile) and/or "memory" (tracemalloc).
+# When unset, handlers are returned undecorated so profiling costs nothing.
+profile_modes = {
+    mode.strip()
+    for mode in os.getenv("DKMS_PROFILE", "").split(",")
+    if mode.strip() in ("cpu", "memory")
+}
+sample_rate = float(os.getenv("DKMS_PROFILE_SAMPLE_RATE", "1"))
+top_n = int(os.getenv("DKMS_PROFILE_TOP_N", "15"))
+# Directory to write full pstats dumps to, e.g. /tmp
+dump_dir = os.getenv("DKMS_PROFILE_DUMP_DIR", None)
+# Let callers force profiling of a request with the X-DKMS-Profile header
+allow_header = os.getenv("DKMS_PROFILE_ALLOW_HEADER", "false").lower() == "true"
+memory_limit_mb = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "0"))
+
+# cProfile and tracemalloc cannot profile overlapping invocations (tracemalloc
+# is process wide), so only one invocation per process is profiled at a time.
+profile_lock = threading.Lock()
+
+
+def profiled(fn):
+    """Profile invocations of a Lambda handler when profiling is enabled."""
+    if not profile_modes:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(event, context):
+        if not should_profile(event) or not profile_lock.acquire(blocking=False):
+            return fn(event, context)
+        try:
+            return profile_invocation(fn, event, context)
+        finally:
+            profile_lock.release()
+
+    return wrapper
+
+
+def should_profile(event) -> bool:
+    """Decide whether to profile this invocation."""
+    if allow_header and (event.get("headers") or {}).get("x-dkms-profile") == "1":
+        return True
+    return random.random() < sample_rate
+
+
+def profile_invocation(fn, event, context):
+    """Run the handler under the enabled profilers and log a summary."""
+    profiler = cProfile.Profile() if "cpu" in profile_modes else None
+    if "memory" in profile_modes:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return fn(event, context)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        summary = {
+            "message": "profile",
+            "path": event.get("rawPath"),
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+        }
+        if profiler is not None:
+            summary["cpu"] = cpu_summary(profiler)
+            if dump_dir is not None:
+                request_id = getattr(context, "aws_request_id", None) or int(
+                    time.time() * 1000
+                )
+                path = os.path.join(dump_dir, f"dkms-profile-{request_id}.pstats")
+                profiler.dump_stats(path)
+                summary["pstats_path"] = path
+        if "memory" in profile_modes:
+            summary["memory"] = memory_summary()
+            tracemalloc.stop()
+        logger.info(summary)
+
+
+def cpu_summary(profiler: cProfile.Profile) -> list:
+    """Return the top functions by cumulative time."""
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top_n]
+    return [
+        {
+            "function": f"{os.path.basename(filename)}:{line}({name})",
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 3),
+            "cumtime_ms": round(cumtime * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in top
+    ]
+
+
+def memory_summary() -> dict:
+    """Return the top allocation sites and peak memory against the limit."""
+    _, peak_traced = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics("lineno")[:top_n]
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    summary = {
+        "peak_traced_bytes": peak_traced,
+        "peak_rss_bytes": peak_rss,
+        "top_allocations": [
+            {
+                "site": f"{os.path.basename(stat.traceback[0].filename)}:"
+                f"{stat.traceback[0].lineno}",
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in statistics
+        ],
+    }
+    if memory_limit_mb:
+        summary["limit_bytes"] = memory_limit_mb * 1024 * 1024
+        summary["peak_rss_percent_of_limit"] = round(
+            100 * peak_rss / summary["limit_bytes"], 1
+        )
+    return summary
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger()
+
+
+class RateLimitedError(Exception):
+    """Raised when a tenant has exhausted its request budget."""
+
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"tenant {tenant} is rate limited")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+class BucketStoreError(Exception):
+    """Raised when a shared bucket store cannot be read or updated."""
+
+    pass
+
+
+def refill(tokens: float, updated_at: float, rate: float, burst: float, now: float):
+    """Return the tokens in a bucket after refilling it up to `now`."""
+    return min(burst, tokens + max(now - updated_at, 0) * rate)
+
+
+class InMemoryBucketStore:
+    """Keep token buckets in this container, evicting the least recently used."""
+
+    def __init__(self, max_tenants: int = 10000):
+        self.max_tenants = max_tenants
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, tenant: str, rate: float, burst: float, now: float) -> float:
+        """Take a token from the tenant's bucket.
+
+        Returns 0 if a token was taken, otherwise the seconds until one will be
+        available.
+        """
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(tenant, (burst, now))
+            tokens = refill(tokens, updated_at, rate, burst, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[tenant] = (tokens, now)
+            if len(self.buckets) > self.max_tenants:
+                self.buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / rate
+
+
+class DynamoDBBucketStore:
+    """Share request budgets between containers through a DynamoDB table.
+
+    Each tenant may make `burst` requests per window of `burst / rate`
+    seconds, which averages out to `rate`. Requests are counted with a single
+    conditional UpdateItem on the tenant's item for the current window, so
+    containers never race each other. The table is keyed by a "tenant"
+    string and expires items through "ttl".
+    """
+
+    def __init__(self, table_name: str):
+        import boto3
+        import botocore.exceptions
+
+        self.table_name = table_name
+        self.client = boto3.client("dynamodb")
+        self.errors = (
+            botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError,
+        )
+
+    def take(self, tenant: str, rate: float, burst: float, now: float) -> float:
+        try:
+            return self.update(tenant, rate, burst, now)
+        except self.errors as e:
+            raise BucketStoreError(str(e)) from e
+
+    def update(self, tenant: str, rate: float, burst: float, now: float) -> float:
+        window_seconds = burst / rate
+        window = int(now // window_seconds)
+        window_end = (window + 1) * window_seconds
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={"tenant": {"S": f"{tenant}#{window}"}},
+                UpdateExpression="ADD #requests :one SET #ttl = :ttl",
+                ConditionExpression=(
+                    "attribute_not_exists(#requests) OR #requests < :limit"
+                ),
+                ExpressionAttributeNames={"#requests": "requests", "#ttl": "ttl"},
+                ExpressionAttributeValues={
+                    ":one": {"N": "1"},
+                    ":limit": {"N": str(int(burst))},
+                    ":ttl": {"N": str(int(window_end + 3600))},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return window_end - now
+        return 0.0
+
+
+class TenantRateLimiter:
+    """Admit requests per tenant through token buckets.
+
+    A tenant whose limit has a rate of 0 is blocked.
+    """
+
+    # Seconds blocked tenants are told to wait
+    blocked_retry_after = 60.0
+
+    def __init__(
+        self, store, rate: float, burst: float, limits: dict = None, max_tenants=1000
+    ):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        if rate <= 0 or burst < 1:
+            raise ValueError("the tenant rate limit and burst must be positive")
+        for tenant in self.limits:
+            tenant_rate, tenant_burst = self.limit_of(tenant)
+            if tenant_rate < 0 or (tenant_rate > 0 and tenant_burst < 1):
+                raise ValueError(f"invalid rate limit for tenant {tenant}")
+        # Per-tenant counters for the most recently seen tenants
+        self.max_tenants = max_tenants
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def limit_of(self, tenant: str) -> tuple:
+        """Return the (rate, burst) of a tenant's bucket."""
+        limit = self.limits.get(tenant, {})
+        rate = float(limit.get("rate", self.rate))
+        burst = float(limit.get("burst", limit.get("rate", self.burst)))
+        return rate, burst
+
+    def check(self, tenant: str) -> None:
+        """Take a token for the tenant, raising RateLimitedError if there is none."""
+        rate, burst = self.limit_of(tenant)
+        if rate <= 0:
+            retry_after = self.blocked_retry_after
+        else:
+            try:
+                retry_after = self.store.take(tenant, rate, burst, time.time())
+            except BucketStoreError:
+                # The limiter protects KMS quota; it should not take the API down
+                logger.exception("rate limit store failed, admitting request")
+                metrics.registry.increment("ratelimit.store_errors")
+                retry_after = 0.0
+
+        outcome = "throttled" if retry_after > 0 else "admitted"
+        metrics.registry.increment(f"ratelimit.{outcome}")
+        with self.lock:
+            counts = self.counts.pop(tenant, {"admitted": 0, "throttled": 0})
+            counts[outcome] += 1
+            self.counts[tenant] = counts
+            if len(self.counts) > self.max_tenants:
+                self.counts.popitem(last=False)
+        if retry_after > 0:
+            raise RateLimitedError(tenant, retry_after)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.counts), "tenants": dict(self.counts)}
+
+
+def limiter_from_env():
+    """Return the tenant rate limiter configured in the environment, if any."""
+    rate = os.getenv("DKMS_TENANT_RATE", None)
+    if rate is None:
+        return None
+
+    table_name = os.getenv("DKMS_TENANT_TABLE", None)
+    store = (
+        DynamoDBBucketStore(table_name)
+        if table_name is not None
+        else InMemoryBucketStore()
+    )
+    return TenantRateLimiter(
+        store,
+        rate=float(rate),
+        burst=float(os.getenv("DKMS_TENANT_BURST", rate)),
+        limits=json.loads(os.getenv("DKMS_TENANT_LIMITS", "{}")),
+    )
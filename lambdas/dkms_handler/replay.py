@@ -0,0 +1,234 @@
+"""Replay captured traffic against index.handler with a local KMS stand-in.
+
+Records captured with DKMS_CAPTURE=true (see capture.py) are re-driven with
+their recorded inter-arrival times. Tokens and ciphertexts are synthesized per
+recorded digest, so token reuse and repeat ciphertexts are preserved. Prints a
+JSON report of latency per route, KMS call counts and cache statistics.
+
+    poetry run python replay.py capture.jsonl --speed 2 --kms-latency-ms 8
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from local_kms import LocalKMS
+
+
+def load_records(path: str) -> list:
+    """Load capture records from a JSON lines file or exported log lines."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            start = line.find("{")
+            if start == -1:
+                continue
+            try:
+                record = json.loads(line[start:])
+            except ValueError:
+                continue
+            if record.get("message") == "capture":
+                records.append(record)
+    return sorted(records, key=lambda record: record["ts"])
+
+
+def percentile(values: list, pct: float) -> float:
+    """Return the nearest-rank percentile of a list of values."""
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class TrafficSynthesizer:
+    """Build handler events from capture records.
+
+    Each recorded token digest maps to one signed token, and each recorded
+    ciphertext digest to one ciphertext valid for that token's ewi.
+    """
+
+    def __init__(self, sign_token, kms, kms_key_id: str):
+        self.sign_token = sign_token
+        self.kms = kms
+        self.kms_key_id = kms_key_id
+        self.tokens = {}
+        self.ciphertexts = {}
+
+    def prepare(self, records: list) -> None:
+        """Create every token and ciphertext up front, outside the replay."""
+        for record in records:
+            self.token(record.get("token_digest"))
+            if record.get("ciphertext_digest"):
+                self.ciphertext(record["ciphertext_digest"], record["token_digest"])
+        self.kms.calls.clear()
+
+    def token(self, token_digest):
+        if token_digest is None:
+            return None
+        if token_digest not in self.tokens:
+            self.tokens[token_digest] = self.sign_token(
+                {"sub": token_digest, "ewi": self.ewi(token_digest)}
+            )
+        return self.tokens[token_digest]
+
+    def ewi(self, token_digest) -> str:
+        return (token_digest or "anonymous")[:16]
+
+    def ciphertext(self, ciphertext_digest: str, token_digest) -> str:
+        if ciphertext_digest not in self.ciphertexts:
+            response = self.kms.encrypt(
+                KeyId=self.kms_key_id,
+                EncryptionContext={"ewi": self.ewi(token_digest)},
+                Plaintext=f"share-{ciphertext_digest}",
+            )
+            self.ciphertexts[ciphertext_digest] = base64.b64encode(
+                response["CiphertextBlob"]
+            ).decode("utf-8")
+        return self.ciphertexts[ciphertext_digest]
+
+    def event(self, record: dict) -> dict:
+        headers = {"content-type": "application/json"}
+        token = self.token(record.get("token_digest"))
+        if token is not None:
+            headers["authorization"] = f"Bearer {token}"
+
+        path, body = record["path"], None
+        if path == "/encrypt":
+            # Approximate the recorded body size around the JSON envelope
+            body = json.dumps(
+                {"plaintext": "x" * max(record.get("body_bytes", 0) - 17, 1)}
+            )
+        elif path == "/decrypt" and record.get("ciphertext_digest"):
+            body = json.dumps(
+                {
+                    "ciphertext": self.ciphertext(
+                        record["ciphertext_digest"], record.get("token_digest")
+                    )
+                }
+            )
+        elif path == "/jobs":
+            body = json.dumps({"operation": "encrypt", "items": ["x"]})
+        elif path == "/jobs/{job_id}":
+            path = "/jobs/replayed"  # Job ids are not captured
+
+        return {
+            "rawPath": path,
+            "requestContext": {"http": {"method": record["method"], "path": path}},
+            "headers": headers,
+            "body": body,
+        }
+
+
+def replay(records: list, handler, synthesizer, speed: float = 1.0) -> dict:
+    """Drive the handler with the records, keeping their inter-arrival times.
+
+    Requests are sent one at a time, as to a single Lambda container, so a slow
+    request delays the ones behind it. A speed of 0 replays without waiting.
+    """
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    if not records:
+        return {"requests": 0, "routes": {}, "kms_calls": {}}
+
+    started = time.perf_counter()
+    first_ts = records[0]["ts"]
+    for record in records:
+        if speed > 0:
+            wait = (record["ts"] - first_ts) / speed - (time.perf_counter() - started)
+            if wait > 0:
+                time.sleep(wait)
+        event = synthesizer.event(record)
+        start = time.perf_counter()
+        response = handler(event, None)
+        route = f"{record['method']} {record['path']}"
+        latencies[route].append((time.perf_counter() - start) * 1000)
+        statuses[route][str(response["statusCode"])] += 1
+
+    return {
+        "requests": len(records),
+        "duration_s": round(time.perf_counter() - started, 3),
+        "routes": {
+            route: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50), 3),
+                "p95_ms": round(percentile(values, 95), 3),
+                "p99_ms": round(percentile(values, 99), 3),
+                "max_ms": round(max(values), 3),
+                "statuses": dict(statuses[route]),
+            }
+            for route, values in sorted(latencies.items())
+        },
+        "kms_calls": dict(synthesizer.kms.calls),
+    }
+
+
+def serve_jwks(jwks: dict) -> str:
+    """Serve a JWKS document from a local HTTP server and return its URL."""
+    document = json.dumps(jwks).encode("utf-8")
+
+    class JWKSHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(document)))
+            self.end_headers()
+            self.wfile.write(document)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JWKSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/.well-known/jwks.json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture_file", help="JSON lines or log export of captures")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="time scale, 0 to not wait"
+    )
+    parser.add_argument(
+        "--kms-latency-ms", type=float, default=0, help="simulated KMS latency"
+    )
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "replay", "use": "sig", "alg": "RS256"})
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    os.environ["DKMS_KMS_KEY_ID"] = "replay-key"
+    os.environ["JWKS_URL"] = serve_jwks({"keys": [jwk]})
+    os.environ["CORS_ALLOW_ORIGINS"] = "*"
+    os.environ.setdefault("DKMS_JOB_LOCAL_DIR", tempfile.mkdtemp())
+    # Imported once the environment it reads at import time is in place
+    import index
+
+    kms = LocalKMS(latency_ms=args.kms_latency_ms)
+    index.kms_client = kms
+    synthesizer = TrafficSynthesizer(
+        lambda claims: jwt.encode(
+            claims, private_key, algorithm="RS256", headers={"kid": "replay"}
+        ),
+        kms,
+        index.kms_key_id,
+    )
+    records = load_records(args.capture_file)
+    synthesizer.prepare(records)
+
+    report = replay(records, index.handler, synthesizer, speed=args.speed)
+    report["caches"] = index.metrics.registry.snapshot()["caches"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
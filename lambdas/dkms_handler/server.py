@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+port = int(os.getenv("PORT", "8080"))
+# Requests are handled on a thread pool so that blocking KMS and JWKS calls
+# for one request do not stall the others sharing the event loop.
+concurrency = int(os.getenv("DKMS_SERVER_CONCURRENCY", "64"))
+# Give every request thread a KMS connection unless the pool is sized
+# explicitly. The handler reads this when it is imported.
+os.environ.setdefault("DKMS_KMS_MAX_POOL_CONNECTIONS", str(concurrency))
+
+import index
+
+# Keep idle connections open for longer than the ALB idle timeout (60s) so the
+# load balancer, not the target, is always the side that closes them.
+keepalive_timeout = float(os.getenv("DKMS_SERVER_KEEPALIVE_TIMEOUT", "75"))
+# Match the API Gateway payload limit
+max_body_size = int(os.getenv("DKMS_SERVER_MAX_BODY_SIZE", str(10 * 1024 * 1024)))
+
+
+class BadRequestError(Exception):
+    """Raised when an HTTP request cannot be parsed."""
+
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+def build_event(method: str, target: str, headers: dict, body: bytes) -> dict:
+    """Translate an HTTP request into an API Gateway HTTP API (v2) event."""
+    url = urlsplit(target)
+    return {
+        "version": "2.0",
+        "rawPath": url.path,
+        "rawQueryString": url.query,
+        "headers": headers,
+        "requestContext": {"http": {"method": method, "path": url.path}},
+        "body": body.decode("utf-8") if body else None,
+        "isBase64Encoded": False,
+    }
+
+
+def format_response(response: dict, keep_alive: bool) -> bytes:
+    """Serialize a handler response into an HTTP/1.1 response message."""
+    status = HTTPStatus(response["statusCode"])
+    body = response.get("body", "").encode("utf-8")
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+    for name, value in response.get("headers", {}).items():
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        lines.append(f"{name}: {value}")
+    lines.append(f"Content-Length: {len(body)}")
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def error_response(status: HTTPStatus) -> dict:
+    """Return a bare error response for requests that never reach the router."""
+    return {
+        "statusCode": status.value,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(
+            {
+                "data": {},
+                "error_code": "INVALID_INPUT",
+                "message": status.phrase.lower(),
+                "status": status.name,
+            }
+        ),
+    }
+
+
+async def read_line(reader: asyncio.StreamReader) -> bytes:
+    try:
+        return await reader.readline()
+    except ValueError:
+        # Longer than the stream's limit (64 KiB)
+        raise BadRequestError(HTTPStatus.BAD_REQUEST)
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """Read one request from the connection, or return None at end of stream."""
+    request_line = await read_line(reader)
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise BadRequestError(HTTPStatus.BAD_REQUEST)
+
+    # Header names are lowercased to match what API Gateway passes to Lambda
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    # Only Content-Length framed bodies are read. Rejecting others keeps their
+    # bytes from being parsed as the next request on the connection.
+    if "transfer-encoding" in headers:
+        chunked = headers["transfer-encoding"].lower().endswith("chunked")
+        raise BadRequestError(
+            HTTPStatus.LENGTH_REQUIRED if chunked else HTTPStatus.NOT_IMPLEMENTED
+        )
+    try:
+        content_length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise BadRequestError(HTTPStatus.BAD_REQUEST)
+    if content_length < 0:
+        raise BadRequestError(HTTPStatus.BAD_REQUEST)
+    if content_length > max_body_size:
+        raise BadRequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(content_length) if content_length else b""
+
+    keep_alive = headers.get("connection", "").lower() != "close" and (
+        version == "HTTP/1.1" or headers.get("connection", "").lower() == "keep-alive"
+    )
+    try:
+        return build_event(method, target, headers, body), keep_alive
+    except UnicodeDecodeError:
+        raise BadRequestError(HTTPStatus.BAD_REQUEST)
+
+
+async def handle_connection(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    executor: ThreadPoolExecutor,
+) -> None:
+    """Serve requests on a single (possibly keep-alive) connection."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(
+                    read_request(reader), timeout=keepalive_timeout
+                )
+            except BadRequestError as e:
+                writer.write(format_response(error_response(e.status), False))
+                break
+            if request is None:
+                break
+
+            event, keep_alive = request
+            response = await loop.run_in_executor(executor, index.handler, event, None)
+            writer.write(format_response(response, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(
+    host: str, port: int, executor: ThreadPoolExecutor
+) -> asyncio.Server:
+    """Start serving the DKMS API on the given address."""
+    return await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, executor),
+        host=host,
+        port=port,
+    )
+
+
+async def serve(host: str = "0.0.0.0", port: int = port) -> None:
+    """Serve the DKMS API until SIGTERM or SIGINT is received."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        server = await start_server(host, port, executor)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        logger.info({"message": "serving", "host": host, "port": port})
+        async with server:
+            await stop.wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s")
+    asyncio.run(serve())
@@ -0,0 +1,319 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+BLOB_FIELDS = {"Plaintext", "CiphertextBlob"}
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "KMSInternalException",
+    "DependencyTimeoutException",
+}
+CONTAINER_CREDENTIALS_HOST = "http://169.254.170.2"
+
+
+class KMSClientError(Exception):
+    """Raised when a KMS call fails, shaped like a botocore ClientError."""
+
+    def __init__(self, operation: str, code: str, message: str, status: int = None):
+        super().__init__(f"An error occurred ({code}) when calling {operation}")
+        self.operation_name = operation
+        self.response = {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+class Credentials:
+    """Resolve AWS credentials from the environment.
+
+    Lambda provides static credentials in environment variables. ECS tasks
+    provide a container credentials endpoint instead, whose temporary
+    credentials are refreshed shortly before they expire.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        self.expires_at = None
+
+    def get(self) -> tuple:
+        if os.getenv("AWS_ACCESS_KEY_ID") and os.getenv("AWS_SECRET_ACCESS_KEY"):
+            return (
+                os.environ["AWS_ACCESS_KEY_ID"],
+                os.environ["AWS_SECRET_ACCESS_KEY"],
+                os.getenv("AWS_SESSION_TOKEN"),
+            )
+        with self.lock:
+            if self.current is None or (
+                self.expires_at is not None and time.time() > self.expires_at - 300
+            ):
+                self.current, self.expires_at = self.fetch_container_credentials()
+            return self.current
+
+    def fetch_container_credentials(self):
+        url = os.getenv("AWS_CONTAINER_CREDENTIALS_FULL_URI")
+        if url is None and os.getenv("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI"):
+            url = CONTAINER_CREDENTIALS_HOST + os.getenv(
+                "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI"
+            )
+        if url is None:
+            raise KMSClientError("Credentials", "NoCredentials", "no AWS credentials")
+
+        request = urllib.request.Request(url)
+        if os.getenv("AWS_CONTAINER_AUTHORIZATION_TOKEN"):
+            request.add_header(
+                "Authorization", os.environ["AWS_CONTAINER_AUTHORIZATION_TOKEN"]
+            )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            data = json.load(response)
+        expires_at = None
+        if data.get("Expiration"):
+            expires_at = datetime.datetime.fromisoformat(
+                data["Expiration"].replace("Z", "+00:00")
+            ).timestamp()
+        return (
+            data["AccessKeyId"],
+            data["SecretAccessKey"],
+            data.get("Token"),
+        ), expires_at
+
+
+class ConnectionPool:
+    """Reuse keep-alive HTTP(S) connections to a single host."""
+
+    def __init__(self, endpoint_url: str, max_connections: int, timeout: float):
+        url = urlsplit(endpoint_url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=max_connections)
+
+    def get(self) -> http.client.HTTPConnection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection: http.client.HTTPConnection) -> None:
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class KMSClient:
+    """Call the KMS operations the handler uses without boto3.
+
+    Requests use the KMS JSON protocol, signed with SigV4 and sent over a pool
+    of keep-alive connections. Methods take and return the same arguments and
+    shapes as the boto3 client, and failures raise KMSClientError carrying a
+    botocore-style `response`, so callers can treat both clients alike.
+    """
+
+    service = "kms"
+    target_prefix = "TrentService"
+
+    def __init__(
+        self,
+        region: str = None,
+        endpoint_url: str = None,
+        max_pool_connections: int = 10,
+        max_attempts: int = 3,
+        timeout: float = 10,
+        credentials: Credentials = None,
+    ):
+        self.region = (
+            region or os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION")
+        )
+        self.endpoint_url = (
+            endpoint_url or f"https://{self.service}.{self.region}.amazonaws.com"
+        )
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.max_attempts = max_attempts
+        self.credentials = credentials or Credentials()
+        self.pool = ConnectionPool(self.endpoint_url, max_pool_connections, timeout)
+
+    def encrypt(self, **kwargs) -> dict:
+        return self.call("Encrypt", kwargs)
+
+    def decrypt(self, **kwargs) -> dict:
+        return self.call("Decrypt", kwargs)
+
+    def generate_data_key(self, **kwargs) -> dict:
+        return self.call("GenerateDataKey", kwargs)
+
+    def re_encrypt(self, **kwargs) -> dict:
+        return self.call("ReEncrypt", kwargs)
+
+    def describe_key(self, **kwargs) -> dict:
+        return self.call("DescribeKey", kwargs)
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def call(self, operation: str, params: dict) -> dict:
+        """Call a KMS operation, retrying throttled and transient failures."""
+        body = json.dumps(
+            {key: encode_blob(key, value) for key, value in params.items()}
+        ).encode("utf-8")
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                status, data = self.send(operation, body)
+            except (http.client.HTTPException, OSError):
+                if attempt == self.max_attempts:
+                    raise
+                continue
+            except KMSClientError as e:
+                error = e  # The response could not be parsed
+            else:
+                if status == 200:
+                    return {key: decode_blob(key, value) for key, value in data.items()}
+                code = str(data.get("__type", "UnknownError")).rsplit("#", 1)[-1]
+                error = KMSClientError(
+                    operation,
+                    code,
+                    data.get("message", data.get("Message", "")),
+                    status,
+                )
+
+            code = error.response["Error"]["Code"]
+            status = error.response["ResponseMetadata"]["HTTPStatusCode"]
+            if (
+                code not in RETRYABLE_ERROR_CODES and status < 500
+            ) or attempt == self.max_attempts:
+                raise error
+            time.sleep(min(0.05 * 2**attempt, 2.0) * random.uniform(0.5, 1.0))
+
+    def send(self, operation: str, body: bytes) -> tuple:
+        headers = {
+            "Content-Type": "application/x-amz-json-1.1",
+            "X-Amz-Target": f"{self.target_prefix}.{operation}",
+        }
+        headers.update(
+            self.sign(body, headers, datetime.datetime.now(datetime.timezone.utc))
+        )
+
+        connection = self.pool.get()
+        while True:
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", "/", body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except ConnectionError:
+                connection.close()
+                if not reused:
+                    raise
+                # An idle keep-alive connection the server has since closed.
+                # Send the request again straight away on a new connection,
+                # as this is not a failure of the call.
+                continue
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                raise
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        try:
+            return response.status, json.loads(data) if data else {}
+        except ValueError:
+            # e.g. an HTML error page from a proxy in front of the endpoint
+            raise KMSClientError(
+                operation,
+                "InvalidResponse",
+                f"unparseable response body with HTTP status {response.status}",
+                response.status,
+            )
+
+    def sign(self, body: bytes, headers: dict, now: datetime.datetime) -> dict:
+        """Return the SigV4 headers for a POST of `body` to the KMS endpoint."""
+        access_key, secret_key, session_token = self.credentials.get()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = amz_date[:8]
+        signed = {key.lower(): value for key, value in headers.items()}
+        signed["host"] = self.host
+        signed["x-amz-date"] = amz_date
+        if session_token:
+            signed["x-amz-security-token"] = session_token
+
+        signed_headers = ";".join(sorted(signed))
+        canonical_request = "\n".join(
+            [
+                "POST",
+                "/",
+                "",
+                "".join(f"{key}:{signed[key].strip()}\n" for key in sorted(signed)),
+                signed_headers,
+                hashlib.sha256(body).hexdigest(),
+            ]
+        )
+        scope = f"{date}/{self.region}/{self.service}/aws4_request"
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+        key = f"AWS4{secret_key}".encode("utf-8")
+        for part in (date, self.region, self.service, "aws4_request"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(
+            key, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+        result = {
+            "X-Amz-Date": amz_date,
+            "Authorization": f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}",
+        }
+        if session_token:
+            result["X-Amz-Security-Token"] = session_token
+        return result
+
+
+class SSMClient(KMSClient):
+    """Call SSM GetParameter the same way, for the key routing map."""
+
+    service = "ssm"
+    target_prefix = "AmazonSSM"
+
+    def get_parameter(self, **kwargs) -> dict:
+        return self.call("GetParameter", kwargs)
+
+
+def encode_blob(key: str, value):
+    if key not in BLOB_FIELDS:
+        return value
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return base64.b64encode(value).decode("ascii")
+
+
+def decode_blob(key: str, value):
+    return base64.b64decode(value) if key in BLOB_FIELDS else value
@@ -0,0 +1,65 @@
+import json
+from unittest.mock import patch
+
+import capture
+
+
+def fake_handler(event, context):
+    return {"statusCode": 400, "body": json.dumps({"error_code": "INVALID_INPUT"})}
+
+
+def test_captured_is_noop_when_disabled():
+    with patch("capture.capture_enabled", False):
+        assert capture.captured(fake_handler) is fake_handler
+
+
+def test_capture_record_omits_bodies_and_tokens():
+    event = {
+        "rawPath": "/decrypt",
+        "requestContext": {"http": {"method": "POST"}},
+        "headers": {"authorization": "Bearer secret-token"},
+        "body": json.dumps({"ciphertext": "c2VjcmV0"}),
+    }
+    record = capture.capture_record(
+        event, fake_handler(event, None), 1700000000.5, 12.3456, True
+    )
+    assert record == {
+        "message": "capture",
+        "ts": 1700000000.5,
+        "method": "POST",
+        "path": "/decrypt",
+        "status": 400,
+        "error_code": "INVALID_INPUT",
+        "duration_ms": 12.346,
+        "cold": True,
+        "body_bytes": len(event["body"]),
+        "token_digest": capture.digest("secret-token"),
+        "ciphertext_digest": capture.digest("c2VjcmV0"),
+    }
+    assert "secret-token" not in json.dumps(record)
+    assert "c2VjcmV0" not in json.dumps(record)
+
+
+def test_capture_record_collapses_job_ids():
+    event = {"rawPath": "/jobs/1234", "requestContext": {"http": {"method": "GET"}}}
+    record = capture.capture_record(
+        event, {"statusCode": 404, "body": "{}"}, 0, 0, False
+    )
+    assert record["path"] == "/jobs/{job_id}"
+    assert record["token_digest"] is None
+    assert record["ciphertext_digest"] is None
+
+
+def test_captured_writes_records(tmp_path):
+    capture_file = tmp_path / "capture.jsonl"
+    event = {"rawPath": "/encrypt", "requestContext": {"http": {"method": "POST"}}}
+    with patch("capture.capture_enabled", True), patch(
+        "capture.capture_file", str(capture_file)
+    ):
+        wrapped = capture.captured(fake_handler)
+        wrapped(event, None)
+        wrapped(event, None)
+
+    records = [json.loads(line) for line in capture_file.read_text().splitlines()]
+    assert [record["path"] for record in records] == ["/encrypt", "/encrypt"]
+    assert [record["cold"] for record in records] == [True, False]
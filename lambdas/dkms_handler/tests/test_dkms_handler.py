@@ -73,6 +73,7 @@ def test_router_decrypt(user_jwt):
             "test_data",
             os.getenv("DKMS_KMS_KEY_ID"),
             encryption_context={"ewi": "abcd1234"},
+            tenant="abcd1234",
         )
 
 
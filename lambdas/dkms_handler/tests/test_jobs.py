@@ -0,0 +1,335 @@
+import base64
+import json
+from http import HTTPStatus
+from unittest.mock import patch
+
+import jwt
+import pytest
+from botocore.exceptions import ClientError, ParamValidationError
+
+import index
+import jobs
+import ratelimit
+from tests.conftest import jwks_dict, test_private_key
+
+
+def job_event(method: str, path: str, token: str, body: str = None) -> dict:
+    return {
+        "rawPath": path,
+        "requestContext": {"http": {"method": method}},
+        "headers": {
+            "Content-Type": "application/json",
+            "authorization": f"Bearer {token}",
+        },
+        "body": body,
+    }
+
+
+def throttling_error() -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+        "Encrypt",
+    )
+
+
+def fake_encrypt(KeyId, EncryptionContext, Plaintext):
+    return {"CiphertextBlob": f"{EncryptionContext['ewi']}:{Plaintext}".encode()}
+
+
+@pytest.fixture(autouse=True)
+def drain_queue():
+    """Start each test with an empty in-memory queue."""
+    _, queue = index.job_backend
+    queue.as_sqs_event()
+    yield
+
+
+def get_chunk(user_jwt, job_id: str, chunk) -> dict:
+    event = job_event("GET", f"/jobs/{job_id}", user_jwt)
+    event["rawQueryString"] = f"chunk={chunk}"
+    return index.handler(event, None)
+
+
+def submit(user_jwt, operation: str, items: list) -> dict:
+    response = index.handler(
+        job_event(
+            "POST",
+            "/jobs",
+            user_jwt,
+            json.dumps({"operation": operation, "items": items}),
+        ),
+        None,
+    )
+    assert response["statusCode"] == HTTPStatus.ACCEPTED.value
+    return json.loads(response["body"])["data"]
+
+
+def test_submit_job_chunks_items(user_jwt):
+    with patch("index.job_chunk_size", 2):
+        data = submit(user_jwt, "encrypt", ["a", "b", "c"])
+    assert data["status"] == "PENDING"
+    assert data["item_count"] == 3
+    assert data["chunk_count"] == 2
+
+    _, queue = index.job_backend
+    assert queue.messages == [
+        {"job_id": data["job_id"], "chunk": 0},
+        {"job_id": data["job_id"], "chunk": 1},
+    ]
+
+
+def test_submit_job_invalid_operation(user_jwt):
+    response = index.handler(
+        job_event(
+            "POST",
+            "/jobs",
+            user_jwt,
+            json.dumps({"operation": "sign", "items": ["a"]}),
+        ),
+        None,
+    )
+    assert response["statusCode"] == HTTPStatus.BAD_REQUEST.value
+    assert json.loads(response["body"])["error_code"] == "INVALID_INPUT"
+
+
+def test_submit_job_too_many_items(user_jwt):
+    with patch("index.job_max_items", 2):
+        response = index.handler(
+            job_event(
+                "POST",
+                "/jobs",
+                user_jwt,
+                json.dumps({"operation": "encrypt", "items": ["a", "b", "c"]}),
+            ),
+            None,
+        )
+    assert response["statusCode"] == HTTPStatus.BAD_REQUEST.value
+
+
+def test_submit_job_invalid_items(user_jwt):
+    response = index.handler(
+        job_event(
+            "POST",
+            "/jobs",
+            user_jwt,
+            json.dumps({"operation": "encrypt", "items": [123, "", {"a": 1}]}),
+        ),
+        None,
+    )
+    assert response["statusCode"] == HTTPStatus.BAD_REQUEST.value
+    assert json.loads(response["body"])["error_code"] == "INVALID_INPUT"
+
+
+def test_job_round_trip(user_jwt):
+    with patch("index.job_chunk_size", 2):
+        data = submit(user_jwt, "encrypt", ["a", "b", "c"])
+
+    pending = index.handler(job_event("GET", f"/jobs/{data['job_id']}", user_jwt), None)
+    assert json.loads(pending["body"])["data"]["status"] == "PENDING"
+
+    _, queue = index.job_backend
+    with patch("index.kms_client.encrypt", side_effect=fake_encrypt):
+        result = index.job_worker_handler(queue.as_sqs_event(), None)
+    assert result == {"batchItemFailures": []}
+
+    response = index.handler(
+        job_event("GET", f"/jobs/{data['job_id']}", user_jwt), None
+    )
+    job = json.loads(response["body"])["data"]
+    assert job["status"] == "COMPLETE"
+    assert job["chunks_complete"] == 2
+    assert "results" not in job
+
+    results = [
+        result
+        for chunk in range(job["chunk_count"])
+        for result in json.loads(get_chunk(user_jwt, data["job_id"], chunk)["body"])[
+            "data"
+        ]["results"]
+    ]
+    assert [base64.b64decode(r["ciphertext"]) for r in results] == [
+        b"abcd1234:a",
+        b"abcd1234:b",
+        b"abcd1234:c",
+    ]
+
+
+def test_get_job_invalid_chunk(user_jwt):
+    data = submit(user_jwt, "encrypt", ["a"])
+    for chunk in ("1", "-1", "first"):
+        response = get_chunk(user_jwt, data["job_id"], chunk)
+        assert response["statusCode"] == HTTPStatus.BAD_REQUEST.value
+        assert json.loads(response["body"])["error_code"] == "INVALID_INPUT"
+
+
+def test_get_job_of_other_ewi_not_found(user_jwt):
+    data = submit(user_jwt, "encrypt", ["a"])
+    other_jwt = jwt.encode(
+        {"sub": "other_user", "ewi": "efgh5678"},
+        test_private_key,
+        algorithm="RS256",
+        headers={"kid": jwks_dict["kid"]},
+    )
+    response = index.handler(
+        job_event("GET", f"/jobs/{data['job_id']}", other_jwt), None
+    )
+    assert response["statusCode"] == HTTPStatus.NOT_FOUND.value
+    assert json.loads(response["body"])["error_code"] == "JOB_NOT_FOUND"
+
+
+def test_worker_reports_throttled_chunks(user_jwt):
+    submit(user_jwt, "encrypt", ["a"])
+    _, queue = index.job_backend
+    event = queue.as_sqs_event()
+    with patch("index.job_kms_max_attempts", 1), patch(
+        "index.kms_client.encrypt", side_effect=throttling_error()
+    ):
+        result = index.job_worker_handler(event, None)
+    assert result == {
+        "batchItemFailures": [{"itemIdentifier": event["Records"][0]["messageId"]}]
+    }
+
+
+def test_worker_records_item_errors(user_jwt):
+    data = submit(user_jwt, "decrypt", ["not base64!"])
+    _, queue = index.job_backend
+    index.job_worker_handler(queue.as_sqs_event(), None)
+
+    response = get_chunk(user_jwt, data["job_id"], 0)
+    assert json.loads(response["body"])["data"]["results"] == [
+        {"error_code": "INVALID_INPUT"}
+    ]
+
+
+@pytest.mark.parametrize(
+    "error", [TypeError("bad plaintext"), ParamValidationError(report="bad")]
+)
+def test_worker_records_client_side_errors(user_jwt, error):
+    data = submit(user_jwt, "encrypt", ["a", "b"])
+    _, queue = index.job_backend
+    with patch(
+        "index.kms_client.encrypt",
+        side_effect=[error, {"CiphertextBlob": b"encrypted"}],
+    ):
+        result = index.job_worker_handler(queue.as_sqs_event(), None)
+    assert result == {"batchItemFailures": []}
+
+    job = json.loads(get_chunk(user_jwt, data["job_id"], 0)["body"])["data"]
+    assert job["status"] == "COMPLETE"
+    assert job["results"] == [
+        {"error_code": "INVALID_INPUT"},
+        {"ciphertext": base64.b64encode(b"encrypted").decode()},
+    ]
+
+
+def test_worker_applies_tenant_rate_limits(user_jwt):
+    clock = [100.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    limiter = ratelimit.TenantRateLimiter(
+        ratelimit.InMemoryBucketStore(),
+        rate=1,
+        burst=2,
+        limits={"blocked": {"rate": 0}},
+    )
+    _, queue = index.job_backend
+    with patch("index.tenant_rate_limiter", limiter), patch(
+        "ratelimit.time.time", side_effect=lambda: clock[0]
+    ), patch("index.time.sleep", side_effect=sleep) as mock_sleep, patch(
+        "index.job_rate_limiter", jobs.RateLimiter(0)
+    ), patch(
+        "index.kms_client.encrypt", side_effect=fake_encrypt
+    ) as mock_encrypt:
+        data = submit(user_jwt, "encrypt", ["a", "b", "c"])
+        assert index.job_worker_handler(queue.as_sqs_event(), None) == {
+            "batchItemFailures": []
+        }
+        # The submission and the first item spent the burst
+        assert [c.args for c in mock_sleep.call_args_list] == [(1.0,), (1.0,)]
+        assert clock[0] == 102.0
+
+        jobs.submit_job(*index.job_backend, "abcd1234", "encrypt", ["d"], 10, "blocked")
+        event = queue.as_sqs_event()
+        assert index.job_worker_handler(event, None) == {
+            "batchItemFailures": [{"itemIdentifier": event["Records"][0]["messageId"]}]
+        }
+
+    assert mock_encrypt.call_count == 3
+    assert limiter.stats()["tenants"]["abcd1234"] == {"admitted": 4, "throttled": 2}
+    job = json.loads(get_chunk(user_jwt, data["job_id"], 0)["body"])["data"]
+    assert job["status"] == "COMPLETE"
+
+
+def test_dead_lettered_chunk_fails_job(user_jwt):
+    with patch("index.job_chunk_size", 1):
+        data = submit(user_jwt, "encrypt", ["a", "b"])
+    _, queue = index.job_backend
+    event = queue.as_sqs_event()
+    with patch("index.kms_client.encrypt", side_effect=fake_encrypt):
+        index.job_worker_handler({"Records": event["Records"][:1]}, None)
+    result = index.job_dead_letter_handler({"Records": event["Records"][1:]}, None)
+    assert result == {"batchItemFailures": []}
+
+    job = json.loads(get_chunk(user_jwt, data["job_id"], 1)["body"])["data"]
+    assert job["status"] == "FAILED"
+    assert (job["chunks_complete"], job["chunks_failed"]) == (1, 1)
+    assert (job["chunk_status"], job["results"]) == ("FAILED", None)
+    job = json.loads(get_chunk(user_jwt, data["job_id"], 0)["body"])["data"]
+    assert job["chunk_status"] == "COMPLETE"
+
+
+def test_kms_call_retries_throttling():
+    with patch("index.time.sleep") as mock_sleep, patch(
+        "index.kms_client.encrypt",
+        side_effect=[throttling_error(), {"CiphertextBlob": b"encrypted"}],
+    ) as mock_encrypt:
+        response = index.kms_call("encrypt", 3, KeyId="mock_kms_key_id")
+    assert response == {"CiphertextBlob": b"encrypted"}
+    assert mock_encrypt.call_count == 2
+    mock_sleep.assert_called_once()
+
+
+def test_kms_call_retries_transient_errors():
+    error = ClientError(
+        {
+            "Error": {"Code": "KMSInternalException"},
+            "ResponseMetadata": {"HTTPStatusCode": 500},
+        },
+        "Encrypt",
+    )
+    with patch("index.time.sleep"), patch(
+        "index.kms_client.encrypt", side_effect=[error, {"CiphertextBlob": b"x"}]
+    ):
+        assert index.kms_call("encrypt", 2, KeyId="mock_kms_key_id") == {
+            "CiphertextBlob": b"x"
+        }
+
+
+def test_kms_call_gives_up_after_max_attempts():
+    with patch("index.time.sleep"), patch(
+        "index.kms_client.encrypt", side_effect=throttling_error()
+    ) as mock_encrypt:
+        with pytest.raises(ClientError):
+            index.kms_call("encrypt", 2, KeyId="mock_kms_key_id")
+    assert mock_encrypt.call_count == 2
+
+
+def test_process_chunk_skips_completed_chunk(tmp_path):
+    store = jobs.LocalJobStore(str(tmp_path))
+    queue = jobs.InMemoryJobQueue()
+    manifest = jobs.submit_job(store, queue, "abcd1234", "encrypt", ["a"], 10)
+    jobs.process_chunk(store, manifest["job_id"], 0, lambda *args: {"ok": True})
+    jobs.process_chunk(store, manifest["job_id"], 0, lambda *args: 1 / 0)
+    assert store.get_json(f"jobs/{manifest['job_id']}/results/0.json") == [{"ok": True}]
+
+
+def test_rate_limiter_paces_calls():
+    limiter = jobs.RateLimiter(10)
+    with patch("jobs.time.sleep") as mock_sleep, patch(
+        "jobs.time.monotonic", return_value=100.0
+    ):
+        limiter.acquire()
+        limiter.acquire()
+    mock_sleep.assert_called_once_with(pytest.approx(0.1))
@@ -0,0 +1,282 @@
+import json
+import threading
+from http import HTTPStatus
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import index
+import jobs
+import keyrouting
+from local_kms import LocalKMS
+
+
+class StaticRouteSource:
+    def __init__(self, routes: dict):
+        self.routes = routes
+        self.loads = 0
+
+    def load(self) -> dict:
+        self.loads += 1
+        return dict(self.routes)
+
+
+def describe_response(key_id: str, state="Enabled", spec="SYMMETRIC_DEFAULT"):
+    return {
+        "KeyMetadata": {
+            "Arn": f"arn:aws:kms:us-west-2:012345678901:key/{key_id}",
+            "KeyState": state,
+            "KeySpec": spec,
+        }
+    }
+
+
+def request_event(path: str, user_jwt: str, body: dict) -> dict:
+    return {
+        "rawPath": path,
+        "requestContext": {"http": {"method": "POST"}},
+        "headers": {"authorization": f"Bearer {user_jwt}"},
+        "body": json.dumps(body),
+    }
+
+
+def test_router_resolves_from_cached_metadata():
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId[6:])
+    router = keyrouting.KeyRouter(
+        StaticRouteSource({"app-1": "alias/app-1", "app-2": "alias/app-1"}), kms
+    )
+
+    for _ in range(3):
+        assert router.resolve("app-1") == (
+            "arn:aws:kms:us-west-2:012345678901:key/app-1"
+        )
+    assert router.resolve("app-3") is None
+    kms.describe_key.assert_called_once_with(KeyId="alias/app-1")
+    assert router.stats()["keys"]["alias/app-1"]["enabled"] is True
+
+
+def test_router_rejects_unusable_keys():
+    kms = MagicMock()
+    kms.describe_key.side_effect = [
+        describe_response("a", state="Disabled"),
+        describe_response("b", spec="RSA_2048"),
+    ]
+    router = keyrouting.KeyRouter(StaticRouteSource({"app-1": "a"}), kms)
+    with pytest.raises(keyrouting.KeyUnavailableError):
+        router.resolve("app-1")
+
+    router = keyrouting.KeyRouter(StaticRouteSource({"app-1": "b"}), kms)
+    with pytest.raises(keyrouting.KeyUnavailableError):
+        router.resolve("app-1")
+
+
+def test_router_uses_key_id_when_describe_fails():
+    kms = MagicMock()
+    kms.describe_key.side_effect = RuntimeError("kms unavailable")
+    router = keyrouting.KeyRouter(StaticRouteSource({"app-1": "alias/app-1"}), kms)
+    assert router.resolve("app-1") == "alias/app-1"
+
+
+def test_router_uses_default_key_until_first_load():
+    source = StaticRouteSource({"app-1": "a"})
+    source.load = MagicMock(side_effect=[OSError("throttled"), {"app-1": "a"}])
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId)
+    router = keyrouting.KeyRouter(source, kms)
+    assert router.stats()["age_seconds"] is None
+
+    with patch("keyrouting.threading.Thread") as mock_thread:
+        assert router.resolve("app-1") is None
+        mock_thread.assert_not_called()  # Not retried before retry_interval
+        router.failed_at -= router.retry_interval
+        assert router.resolve("app-1") is None
+    mock_thread.call_args.kwargs["target"]()
+    assert router.resolve("app-1").endswith("/a")
+
+
+def test_router_describes_keys_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    kms = MagicMock()
+
+    def describe_key(KeyId):
+        barrier.wait()  # Only passes once all three describes are in flight
+        return describe_response(KeyId)
+
+    kms.describe_key.side_effect = describe_key
+    router = keyrouting.KeyRouter(
+        StaticRouteSource({"app-1": "a", "app-2": ["b", "c"]}), kms
+    )
+    assert router.resolve("app-2").endswith("/b")
+    assert router.stats()["keys"]["c"]["enabled"] is True
+
+
+def test_router_refreshes_in_background():
+    source = StaticRouteSource({"app-1": "a"})
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId)
+    router = keyrouting.KeyRouter(source, kms, refresh_interval=60, metadata_ttl=300)
+
+    source.routes = {"app-1": "b"}
+    started = []
+    with patch("keyrouting.threading.Thread") as mock_thread:
+        mock_thread.return_value.start.side_effect = lambda: started.append(1)
+        router.resolve("app-1")  # Fresh map, no refresh
+        router.loaded_at -= 61
+        assert router.resolve("app-1").endswith("/a")  # Served from the old map
+        router.resolve("app-1")  # Refresh already in flight
+    assert started == [1]
+
+    mock_thread.call_args.kwargs["target"]()
+    assert router.resolve("app-1").endswith("/b")
+    assert source.loads == 2
+    assert not router.refresh_lock.locked()
+
+
+def test_router_keeps_last_map_when_refresh_fails():
+    source = StaticRouteSource({"app-1": "a"})
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId)
+    router = keyrouting.KeyRouter(source, kms)
+
+    source.load = MagicMock(side_effect=ValueError("bad document"))
+    router.refresh_lock.acquire()
+    router.background_refresh()
+    assert router.resolve("app-1").endswith("/a")
+    assert not router.refresh_lock.locked()
+
+
+def test_router_redescribes_keys_after_ttl():
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId)
+    router = keyrouting.KeyRouter(
+        StaticRouteSource({"app-1": "a"}), kms, metadata_ttl=300
+    )
+    router.refresh()
+    assert kms.describe_key.call_count == 1
+    router.keys["a"]["fetched_at"] -= 301
+    router.refresh()
+    assert kms.describe_key.call_count == 2
+
+
+def test_router_from_env_reads_file(tmp_path, monkeypatch):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({"app-1": "alias/app-1"}))
+    monkeypatch.setenv("DKMS_KEY_ROUTES_FILE", str(path))
+    router = keyrouting.router_from_env(LocalKMS())
+    assert router.resolve("app-1") == "arn:aws:kms:local:000000000000:key/app-1"
+
+    monkeypatch.delenv("DKMS_KEY_ROUTES_FILE")
+    assert keyrouting.router_from_env(LocalKMS()) is None
+
+
+@pytest.fixture
+def routed_kms():
+    kms = LocalKMS()
+    router = keyrouting.KeyRouter(StaticRouteSource({"abcd1234": "alias/app-1"}), kms)
+    with patch("index.kms_client", kms), patch("index.key_router", router):
+        yield kms
+
+
+def test_requests_use_tenant_key(user_jwt, routed_kms):
+    response = index.handler(
+        request_event("/encrypt", user_jwt, {"plaintext": "secret"}), None
+    )
+    ciphertext = json.loads(response["body"])["data"]["ciphertext"]
+    response = index.handler(
+        request_event("/decrypt", user_jwt, {"ciphertext": ciphertext}), None
+    )
+
+    assert json.loads(response["body"])["data"]["plaintext"] == "secret"
+    assert routed_kms.calls == {"DescribeKey": 1, "Encrypt": 1, "Decrypt": 1}
+    with patch.object(routed_kms, "encrypt", wraps=routed_kms.encrypt) as encrypt:
+        index.handler(request_event("/encrypt", user_jwt, {"plaintext": "x"}), None)
+    assert encrypt.call_args.kwargs["KeyId"] == (
+        "arn:aws:kms:local:000000000000:key/app-1"
+    )
+
+
+def test_decrypt_falls_back_to_default_key(user_jwt, routed_kms):
+    ciphertext = index.kms_encrypt("secret", index.kms_key_id, {"ewi": "abcd1234"})
+    response = index.handler(
+        request_event("/decrypt", user_jwt, {"ciphertext": ciphertext}), None
+    )
+    assert json.loads(response["body"])["data"]["plaintext"] == "secret"
+    assert routed_kms.calls["Decrypt"] == 2
+
+
+@pytest.mark.parametrize(
+    "key_ids, status",
+    [
+        (["alias/app-2", "alias/app-1"], HTTPStatus.OK),
+        ([index.kms_key_id, "alias/app-1"], HTTPStatus.OK),
+        (None, HTTPStatus.FORBIDDEN),
+    ],
+)
+def test_decrypt_after_route_changes(user_jwt, routed_kms, key_ids, status):
+    response = index.handler(
+        request_event("/encrypt", user_jwt, {"plaintext": "secret"}), None
+    )
+    ciphertext = json.loads(response["body"])["data"]["ciphertext"]
+    # Moved to another key, moved back to the shared key, or removed without
+    # keeping the old key listed
+    index.key_router.source.routes = {"abcd1234": key_ids} if key_ids else {}
+    index.key_router.refresh()
+
+    response = index.handler(
+        request_event("/decrypt", user_jwt, {"ciphertext": ciphertext}), None
+    )
+    assert response["statusCode"] == status.value
+    if status == HTTPStatus.OK:
+        assert json.loads(response["body"])["data"]["plaintext"] == "secret"
+
+
+def test_decrypt_rejects_other_tenants_keys(user_jwt, routed_kms):
+    ciphertext = index.kms_encrypt("secret", "alias/other", {"ewi": "abcd1234"})
+    response = index.handler(
+        request_event("/decrypt", user_jwt, {"ciphertext": ciphertext}), None
+    )
+    assert response["statusCode"] == HTTPStatus.FORBIDDEN.value
+    assert json.loads(response["body"])["error_code"] == "KEY_UNAVAILABLE"
+    assert "secret" not in response["body"]
+
+
+def test_router_keeps_keys_listed_for_decrypts():
+    kms = MagicMock()
+    kms.describe_key.side_effect = lambda KeyId: describe_response(KeyId)
+    router = keyrouting.KeyRouter(
+        StaticRouteSource({"t": ["new", "old"]}), kms, default_key_id="default"
+    )
+    assert router.resolve("t").endswith("/new")
+    assert router.decrypt_keys("t") == {
+        key_id
+        for name in ("new", "old", "default")
+        for key_id in (name, f"arn:aws:kms:us-west-2:012345678901:key/{name}")
+    }
+    router.source.routes = {"t": []}
+    with pytest.raises(ValueError):
+        router.refresh()
+
+
+def test_disabled_tenant_key_is_rejected(user_jwt):
+    kms = MagicMock()
+    kms.describe_key.return_value = describe_response("a", state="PendingDeletion")
+    router = keyrouting.KeyRouter(StaticRouteSource({"abcd1234": "a"}), kms)
+    with patch("index.key_router", router):
+        response = index.handler(
+            request_event("/encrypt", user_jwt, {"plaintext": "secret"}), None
+        )
+    assert response["statusCode"] == HTTPStatus.FORBIDDEN.value
+    assert json.loads(response["body"])["error_code"] == "KEY_UNAVAILABLE"
+    kms.encrypt.assert_not_called()
+
+
+def test_job_items_use_tenant_key(tmp_path, routed_kms):
+    store, queue = jobs.LocalJobStore(str(tmp_path)), jobs.InMemoryJobQueue()
+    manifest = jobs.submit_job(
+        store, queue, "efgh5678", "encrypt", ["a"], 10, tenant="abcd1234"
+    )
+    with patch.object(routed_kms, "encrypt", wraps=routed_kms.encrypt) as encrypt:
+        jobs.process_chunk(store, manifest["job_id"], 0, index.process_job_item)
+    assert encrypt.call_args.kwargs["KeyId"].endswith("/app-1")
+    assert encrypt.call_args.kwargs["EncryptionContext"] == {"ewi": "efgh5678"}
@@ -0,0 +1,53 @@
+import pytest
+
+from local_kms import LocalKMS, LocalKMSError
+
+
+def test_encrypt_decrypt_round_trip():
+    kms = LocalKMS()
+    encrypted = kms.encrypt(
+        KeyId="key-1", Plaintext="secret", EncryptionContext={"ewi": "abcd1234"}
+    )
+    decrypted = kms.decrypt(
+        KeyId="key-1",
+        CiphertextBlob=encrypted["CiphertextBlob"],
+        EncryptionContext={"ewi": "abcd1234"},
+    )
+    assert decrypted == {"Plaintext": b"secret", "KeyId": "key-1"}
+    assert kms.calls == {"Encrypt": 1, "Decrypt": 1}
+
+
+def test_decrypt_with_wrong_context_fails():
+    kms = LocalKMS()
+    blob = kms.encrypt(
+        KeyId="key-1", Plaintext="secret", EncryptionContext={"ewi": "abcd1234"}
+    )["CiphertextBlob"]
+    with pytest.raises(LocalKMSError) as e:
+        kms.decrypt(CiphertextBlob=blob, EncryptionContext={"ewi": "efgh5678"})
+    assert e.value.response["Error"]["Code"] == "InvalidCiphertextException"
+
+
+def test_decrypt_with_wrong_key_fails():
+    kms = LocalKMS()
+    blob = kms.encrypt(KeyId="key-1", Plaintext="secret")["CiphertextBlob"]
+    with pytest.raises(LocalKMSError) as e:
+        kms.decrypt(KeyId="key-2", CiphertextBlob=blob)
+    assert e.value.response["Error"]["Code"] == "IncorrectKeyException"
+
+
+def test_generate_data_key_and_re_encrypt():
+    kms = LocalKMS()
+    data_key = kms.generate_data_key(KeyId="key-1", KeySpec="AES_256")
+    assert len(data_key["Plaintext"]) == 32
+
+    re_encrypted = kms.re_encrypt(
+        CiphertextBlob=data_key["CiphertextBlob"],
+        DestinationKeyId="key-2",
+        DestinationEncryptionContext={"ewi": "abcd1234"},
+    )
+    assert re_encrypted["SourceKeyId"] == "key-1"
+    decrypted = kms.decrypt(
+        CiphertextBlob=re_encrypted["CiphertextBlob"],
+        EncryptionContext={"ewi": "abcd1234"},
+    )
+    assert decrypted == {"Plaintext": data_key["Plaintext"], "KeyId": "key-2"}
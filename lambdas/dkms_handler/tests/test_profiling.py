@@ -0,0 +1,68 @@
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import index
+import profiling
+
+
+def fake_handler(event, context):
+    return {"statusCode": 200, "allocated": [bytes(1024) for _ in range(10)]}
+
+
+def test_profiled_is_noop_when_disabled():
+    with patch("profiling.profile_modes", set()):
+        assert profiling.profiled(fake_handler) is fake_handler
+
+
+def test_handlers_are_not_wrapped_by_default():
+    assert not hasattr(index.handler, "__wrapped__")
+    assert not hasattr(index.job_worker_handler, "__wrapped__")
+
+
+def test_profiled_logs_cpu_and_memory_summary():
+    with patch("profiling.profile_modes", {"cpu", "memory"}), patch(
+        "profiling.sample_rate", 1
+    ), patch("profiling.memory_limit_mb", 128), patch(
+        "profiling.logger"
+    ) as mock_logger:
+        response = profiling.profiled(fake_handler)({"rawPath": "/healthz"}, None)
+
+    assert response["statusCode"] == 200
+    summary = mock_logger.info.call_args[0][0]
+    assert summary["message"] == "profile"
+    assert summary["path"] == "/healthz"
+    assert any("fake_handler" in entry["function"] for entry in summary["cpu"])
+    assert summary["memory"]["peak_traced_bytes"] >= 10 * 1024
+    assert summary["memory"]["limit_bytes"] == 128 * 1024 * 1024
+    assert "peak_rss_percent_of_limit" in summary["memory"]
+    assert len(summary["memory"]["top_allocations"]) <= profiling.top_n
+
+
+def test_profiled_dumps_pstats(tmp_path):
+    context = SimpleNamespace(aws_request_id="abc-123")
+    with patch("profiling.profile_modes", {"cpu"}), patch(
+        "profiling.sample_rate", 1
+    ), patch("profiling.dump_dir", str(tmp_path)), patch(
+        "profiling.logger"
+    ) as mock_logger:
+        profiling.profiled(fake_handler)({}, context)
+
+    path = os.path.join(tmp_path, "dkms-profile-abc-123.pstats")
+    assert os.path.exists(path)
+    assert mock_logger.info.call_args[0][0]["pstats_path"] == path
+    assert "memory" not in mock_logger.info.call_args[0][0]
+
+
+def test_profiled_respects_sample_rate_and_header():
+    event = {"headers": {"x-dkms-profile": "1"}}
+    with patch("profiling.profile_modes", {"cpu"}), patch(
+        "profiling.sample_rate", 0
+    ), patch("profiling.logger") as mock_logger:
+        wrapped = profiling.profiled(fake_handler)
+        wrapped(event, None)
+        mock_logger.info.assert_not_called()
+
+        with patch("profiling.allow_header", True):
+            wrapped(event, None)
+        mock_logger.info.assert_called_once()
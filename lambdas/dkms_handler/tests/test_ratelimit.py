@@ -0,0 +1,135 @@
+import json
+from http import HTTPStatus
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import index
+import ratelimit
+
+
+def test_bucket_allows_burst_then_refills():
+    store = ratelimit.InMemoryBucketStore()
+    assert store.take("tenant", rate=1, burst=2, now=100.0) == 0
+    assert store.take("tenant", rate=1, burst=2, now=100.0) == 0
+    assert store.take("tenant", rate=1, burst=2, now=100.0) == pytest.approx(1.0)
+    assert store.take("tenant", rate=1, burst=2, now=100.5) == pytest.approx(0.5)
+    assert store.take("tenant", rate=1, burst=2, now=101.0) == 0
+
+
+def test_bucket_store_evicts_least_recently_used():
+    store = ratelimit.InMemoryBucketStore(max_tenants=2)
+    for tenant in ("a", "b", "c"):
+        store.take(tenant, rate=1, burst=1, now=100.0)
+    assert list(store.buckets) == ["b", "c"]
+
+
+def test_limiter_applies_tenant_limits():
+    limiter = ratelimit.TenantRateLimiter(
+        ratelimit.InMemoryBucketStore(),
+        rate=1,
+        burst=1,
+        limits={"big": {"rate": 10, "burst": 3}},
+    )
+    with patch("ratelimit.time.time", return_value=100.0):
+        for _ in range(3):
+            limiter.check("big")
+        limiter.check("small")
+        with pytest.raises(ratelimit.RateLimitedError):
+            limiter.check("small")
+    assert limiter.stats()["tenants"] == {
+        "big": {"admitted": 3, "throttled": 0},
+        "small": {"admitted": 1, "throttled": 1},
+    }
+
+
+def test_limiter_admits_when_store_fails():
+    store = MagicMock()
+    store.take.side_effect = ratelimit.BucketStoreError("store unavailable")
+    limiter = ratelimit.TenantRateLimiter(store, rate=1, burst=1)
+    limiter.check("tenant")
+    assert limiter.stats()["tenants"]["tenant"]["admitted"] == 1
+
+    store.take.side_effect = RuntimeError("bug")
+    with pytest.raises(RuntimeError):
+        limiter.check("tenant")
+
+
+def test_limiter_blocks_tenants_with_zero_rate():
+    store = ratelimit.InMemoryBucketStore()
+    limiter = ratelimit.TenantRateLimiter(
+        store, rate=10, burst=10, limits={"bad": {"rate": 0}}
+    )
+    for _ in range(5):
+        with pytest.raises(ratelimit.RateLimitedError) as e:
+            limiter.check("bad")
+        assert e.value.retry_after == limiter.blocked_retry_after
+    limiter.check("good")
+    assert limiter.stats()["tenants"]["bad"] == {"admitted": 0, "throttled": 5}
+
+    with pytest.raises(ValueError):
+        ratelimit.TenantRateLimiter(store, rate=0, burst=1)
+    with pytest.raises(ValueError):
+        ratelimit.TenantRateLimiter(
+            store, rate=1, burst=1, limits={"bad": {"rate": 1, "burst": 0}}
+        )
+
+
+def test_dynamodb_store_counts_requests_per_window():
+    store = ratelimit.DynamoDBBucketStore.__new__(ratelimit.DynamoDBBucketStore)
+    store.table_name = "buckets"
+    store.client = MagicMock()
+    store.client.exceptions.ConditionalCheckFailedException = type(
+        "ConditionalCheckFailedException", (Exception,), {}
+    )
+
+    assert store.take("tenant", rate=4, burst=10, now=101.0) == 0
+    update = store.client.update_item.call_args.kwargs
+    assert update["Key"] == {"tenant": {"S": "tenant#40"}}
+    assert update["UpdateExpression"] == "ADD #requests :one SET #ttl = :ttl"
+    assert update["ExpressionAttributeValues"][":limit"] == {"N": "10"}
+    store.client.get_item.assert_not_called()
+
+    store.client.update_item.side_effect = (
+        store.client.exceptions.ConditionalCheckFailedException()
+    )
+    assert store.take("tenant", rate=4, burst=10, now=101.0) == pytest.approx(1.5)
+    assert store.client.update_item.call_count == 2
+
+
+def test_router_rate_limits_tenant(user_jwt):
+    limiter = ratelimit.TenantRateLimiter(
+        ratelimit.InMemoryBucketStore(), rate=0.5, burst=1
+    )
+    event = {
+        "rawPath": "/encrypt",
+        "requestContext": {"http": {"method": "POST"}},
+        "headers": {"authorization": f"Bearer {user_jwt}"},
+        "body": json.dumps({"plaintext": "secret"}),
+    }
+    with patch("index.tenant_rate_limiter", limiter), patch(
+        "index.kms_client.encrypt", return_value={"CiphertextBlob": b"encrypted"}
+    ) as mock_encrypt:
+        assert index.handler(event, None)["statusCode"] == HTTPStatus.OK.value
+        response = index.handler(event, None)
+
+    assert response["statusCode"] == HTTPStatus.TOO_MANY_REQUESTS.value
+    assert response["headers"]["Retry-After"] == "2"
+    assert json.loads(response["body"])["error_code"] == "RATE_LIMITED"
+    mock_encrypt.assert_called_once()
+    assert limiter.stats()["tenants"]["abcd1234"] == {"admitted": 1, "throttled": 1}
+
+
+def test_router_rate_limits_by_configured_claim(user_jwt):
+    limiter = MagicMock()
+    event = {
+        "rawPath": "/decrypt",
+        "requestContext": {"http": {"method": "POST"}},
+        "headers": {"authorization": f"Bearer {user_jwt}"},
+        "body": None,
+    }
+    with patch("index.tenant_rate_limiter", limiter), patch(
+        "index.tenant_claim", "sub"
+    ):
+        index.handler(event, None)
+    limiter.check.assert_called_once_with("test_user")
@@ -0,0 +1,67 @@
+import json
+
+import jwt
+
+import index
+import replay
+from local_kms import LocalKMS
+from tests.conftest import jwks_dict, test_private_key
+
+
+def sign_token(claims: dict) -> str:
+    return jwt.encode(
+        claims, test_private_key, algorithm="RS256", headers={"kid": jwks_dict["kid"]}
+    )
+
+
+def record(ts, method, path, token_digest=None, ciphertext_digest=None) -> dict:
+    return {
+        "message": "capture",
+        "ts": ts,
+        "method": method,
+        "path": path,
+        "body_bytes": 40,
+        "token_digest": token_digest,
+        "ciphertext_digest": ciphertext_digest,
+    }
+
+
+def test_load_records_from_log_export(tmp_path):
+    capture_file = tmp_path / "capture.log"
+    capture_file.write_text(
+        "START RequestId: 1\n"
+        f"2024-01-01T00:00:01Z\t1\tINFO\t{json.dumps(record(2.0, 'GET', '/healthz'))}\n"
+        f"{json.dumps(record(1.0, 'GET', '/healthz'))}\n"
+        '{"message": "not a capture"}\n'
+    )
+    assert [r["ts"] for r in replay.load_records(str(capture_file))] == [1.0, 2.0]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert replay.percentile(values, 50) == 50
+    assert replay.percentile(values, 99) == 99
+    assert replay.percentile([7], 95) == 7
+
+
+def test_replay_reports_latency_and_kms_calls(monkeypatch):
+    kms = LocalKMS()
+    monkeypatch.setattr(index, "kms_client", kms)
+    records = [
+        record(0.0, "GET", "/healthz"),
+        record(0.01, "POST", "/encrypt", "token-a"),
+        record(0.02, "POST", "/decrypt", "token-a", "ciphertext-1"),
+        record(0.03, "POST", "/decrypt", "token-b", "ciphertext-2"),
+        record(0.04, "POST", "/decrypt", "token-a", "ciphertext-1"),
+    ]
+    synthesizer = replay.TrafficSynthesizer(sign_token, kms, index.kms_key_id)
+    synthesizer.prepare(records)
+    assert len(synthesizer.tokens) == 2
+    assert len(synthesizer.ciphertexts) == 2
+
+    report = replay.replay(records, index.handler, synthesizer, speed=0)
+    assert report["requests"] == 5
+    assert report["kms_calls"] == {"Encrypt": 1, "Decrypt": 3}
+    assert report["routes"]["POST /decrypt"]["count"] == 3
+    assert report["routes"]["POST /decrypt"]["statuses"] == {"200": 3}
+    assert report["routes"]["GET /healthz"]["statuses"] == {"200": 1}
@@ -0,0 +1,183 @@
+import asyncio
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from unittest.mock import patch
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def server_port():
+    """Run the server on an ephemeral port in a background event loop."""
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=4)
+    started = threading.Event()
+    state = {}
+
+    async def run():
+        state["stop"] = asyncio.Event()
+        dkms_server = await server.start_server("127.0.0.1", 0, executor)
+        state["port"] = dkms_server.sockets[0].getsockname()[1]
+        started.set()
+        async with dkms_server:
+            await state["stop"].wait()
+        # Close connections that are still open, as asyncio.run() would
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    thread = threading.Thread(target=lambda: loop.run_until_complete(run()))
+    thread.daemon = True
+    thread.start()
+    started.wait(timeout=5)
+    yield state["port"]
+    loop.call_soon_threadsafe(state["stop"].set)
+    thread.join(timeout=5)
+    loop.close()
+    executor.shutdown()
+
+
+def test_build_event():
+    event = server.build_event(
+        "POST",
+        "/encrypt?verbose=1",
+        {"authorization": "Bearer token"},
+        b'{"plaintext": "secret"}',
+    )
+    assert event["rawPath"] == "/encrypt"
+    assert event["rawQueryString"] == "verbose=1"
+    assert event["requestContext"]["http"]["method"] == "POST"
+    assert event["headers"] == {"authorization": "Bearer token"}
+    assert event["body"] == '{"plaintext": "secret"}'
+
+
+def test_build_event_without_body():
+    event = server.build_event("GET", "/healthz", {}, b"")
+    assert event["body"] is None
+
+
+def test_format_response():
+    message = server.format_response(
+        {
+            "statusCode": 200,
+            "headers": {"Access-Control-Allow-Credentials": True},
+            "body": "{}",
+        },
+        keep_alive=True,
+    )
+    assert message == (
+        b"HTTP/1.1 200 OK\r\n"
+        b"Access-Control-Allow-Credentials: true\r\n"
+        b"Content-Length: 2\r\n"
+        b"Connection: keep-alive\r\n"
+        b"\r\n"
+        b"{}"
+    )
+
+
+def test_server_reuses_connection(server_port):
+    connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=5)
+
+    connection.request("GET", "/healthz")
+    response = connection.getresponse()
+    assert response.status == HTTPStatus.OK
+    assert json.loads(response.read())["status"] == "OK"
+
+    connection.request("GET", "/invalid")
+    response = connection.getresponse()
+    assert response.status == HTTPStatus.NOT_FOUND
+    assert json.loads(response.read())["error_code"] == "INVALID_PATH"
+    connection.close()
+
+
+def test_server_encrypt(server_port, user_jwt):
+    with patch(
+        "index.kms_client.encrypt", return_value={"CiphertextBlob": b"encrypted"}
+    ):
+        connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=5)
+        connection.request(
+            "POST",
+            "/encrypt",
+            body=json.dumps({"plaintext": "secret"}),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {user_jwt}",
+            },
+        )
+        response = connection.getresponse()
+        assert response.status == HTTPStatus.OK
+        assert json.loads(response.read())["data"] == {"ciphertext": "ZW5jcnlwdGVk"}
+        connection.close()
+
+
+def test_server_rejects_large_body(server_port):
+    with patch("server.max_body_size", 4):
+        connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=5)
+        connection.request("POST", "/encrypt", body="0123456789")
+        response = connection.getresponse()
+        assert response.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        connection.close()
+
+
+def test_server_rejects_chunked_body(server_port):
+    with socket.create_connection(("127.0.0.1", server_port), timeout=5) as sock:
+        sock.sendall(
+            b"POST /encrypt HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+            b"4\r\nGET \r\n0\r\n\r\n"
+        )
+        response = b""
+        while chunk := sock.recv(4096):
+            response += chunk
+    # One response, and the chunk bytes are never parsed as a second request
+    assert response.startswith(b"HTTP/1.1 411 Length Required\r\n")
+    assert response.count(b"HTTP/1.1") == 1
+    assert b"Connection: close" in response
+
+
+@pytest.mark.parametrize(
+    "request_bytes",
+    [
+        b"POST /encrypt HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+        b"POST /encrypt HTTP/1.1\r\nContent-Length: 2\r\n\r\n\xff\xfe",
+        b"GET /healthz HTTP/1.1\r\nX-Long: " + b"a" * 70000 + b"\r\n\r\n",
+    ],
+    ids=["negative-content-length", "non-utf-8-body", "header-too-long"],
+)
+def test_server_rejects_malformed_requests(server_port, request_bytes):
+    with socket.create_connection(("127.0.0.1", server_port), timeout=5) as sock:
+        sock.sendall(request_bytes)
+        response = b""
+        while chunk := sock.recv(4096):
+            response += chunk
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+    assert b"Connection: close" in response
+
+
+def test_kms_pool_defaults_to_server_concurrency():
+    environment = {**os.environ, "DKMS_SERVER_CONCURRENCY": "32"}
+    environment.pop("DKMS_KMS_MAX_POOL_CONNECTIONS", None)
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import server, index; print(index.kms_max_pool_connections)",
+        ],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.strip() == "32"
@@ -0,0 +1,292 @@
+import datetime
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest.mock import MagicMock, patch
+
+import pytest
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials as BotocoreCredentials
+
+import index
+from local_kms import LocalKMS, serve_http
+from keyrouting import ParameterRouteSource
+from sigv4_kms import Credentials, KMSClient, KMSClientError, SSMClient
+
+
+@pytest.fixture
+def credentials():
+    credentials = MagicMock(spec=Credentials)
+    credentials.get.return_value = ("AKIDEXAMPLE", "secret", "session-token")
+    return credentials
+
+
+@pytest.fixture
+def local_endpoint(credentials):
+    kms = LocalKMS()
+    server, url = serve_http(kms)
+    client = KMSClient(region="us-west-2", endpoint_url=url, credentials=credentials)
+    yield kms, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(
+    "client_class, target",
+    [(KMSClient, "TrentService.Encrypt"), (SSMClient, "AmazonSSM.GetParameter")],
+)
+def test_signature_matches_botocore(credentials, client_class, target):
+    service = client_class.service
+    client = client_class(region="us-west-2", credentials=credentials)
+    body = b'{"KeyId": "key-1", "Plaintext": "c2VjcmV0"}'
+    headers = {
+        "Content-Type": "application/x-amz-json-1.1",
+        "X-Amz-Target": target,
+    }
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    signed = client.sign(body, headers, now)
+
+    request = AWSRequest(
+        method="POST",
+        url=f"https://{service}.us-west-2.amazonaws.com/",
+        data=body,
+        headers=headers,
+    )
+    auth = SigV4Auth(
+        BotocoreCredentials("AKIDEXAMPLE", "secret", "session-token"),
+        service,
+        "us-west-2",
+    )
+    request.context["timestamp"] = "20240102T030405Z"
+    auth._modify_request_before_signing(request)
+    signature = auth.signature(
+        auth.string_to_sign(request, auth.canonical_request(request)), request
+    )
+    assert signed["Authorization"] == (
+        f"AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20240102/us-west-2/{service}/aws4_request, "
+        f"SignedHeaders={auth.signed_headers(auth.headers_to_sign(request))}, "
+        f"Signature={signature}"
+    )
+    assert signed["X-Amz-Security-Token"] == "session-token"
+
+
+def test_ssm_client_reads_key_routes(credentials):
+    client = SSMClient(region="us-west-2", credentials=credentials)
+    response = {"Parameter": {"Name": "routes", "Value": '{"app-1": "alias/a"}'}}
+    with patch.object(client, "send", return_value=(200, response)) as mock_send:
+        routes = ParameterRouteSource("routes", client).load()
+    assert routes == {"app-1": "alias/a"}
+    assert client.endpoint_url == "https://ssm.us-west-2.amazonaws.com"
+    operation, body = mock_send.call_args.args
+    assert operation == "GetParameter"
+    assert json.loads(body) == {"Name": "routes", "WithDecryption": True}
+
+
+def test_round_trip_reuses_connection(local_endpoint):
+    kms, client = local_endpoint
+
+    encrypted = client.encrypt(
+        KeyId="key-1", Plaintext="secret", EncryptionContext={"ewi": "abcd1234"}
+    )
+    connection = client.pool.idle.queue[-1]
+    decrypted = client.decrypt(
+        CiphertextBlob=encrypted["CiphertextBlob"],
+        EncryptionContext={"ewi": "abcd1234"},
+    )
+
+    assert isinstance(encrypted["CiphertextBlob"], bytes)
+    assert decrypted == {"Plaintext": b"secret", "KeyId": "key-1"}
+    assert client.pool.idle.queue == [connection]
+    assert kms.calls == {"Encrypt": 1, "Decrypt": 1}
+
+
+def test_generate_data_key_and_re_encrypt(local_endpoint):
+    _, client = local_endpoint
+
+    data_key = client.generate_data_key(KeyId="key-1", KeySpec="AES_128")
+    reencrypted = client.re_encrypt(
+        CiphertextBlob=data_key["CiphertextBlob"], DestinationKeyId="key-2"
+    )
+    decrypted = client.decrypt(CiphertextBlob=reencrypted["CiphertextBlob"])
+
+    assert len(data_key["Plaintext"]) == 16
+    assert reencrypted["SourceKeyId"] == "key-1"
+    assert decrypted == {"Plaintext": data_key["Plaintext"], "KeyId": "key-2"}
+
+
+def test_errors_are_shaped_like_botocore(local_endpoint):
+    _, client = local_endpoint
+
+    with pytest.raises(KMSClientError) as e:
+        client.decrypt(CiphertextBlob=b"not a ciphertext")
+
+    assert index.kms_error_code(e.value) == "InvalidCiphertextException"
+    assert e.value.response["ResponseMetadata"]["HTTPStatusCode"] == 400
+
+
+def test_throttling_is_retried(credentials):
+    responses = [
+        (400, {"__type": "com.amazonaws.kms#ThrottlingException"}),
+        (200, {"KeyId": "key-1", "CiphertextBlob": "ZW5jcnlwdGVk"}),
+    ]
+
+    class ThrottlingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status, data = responses.pop(0)
+            payload = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    client = KMSClient(
+        region="us-west-2",
+        endpoint_url=f"http://127.0.0.1:{server.server_address[1]}",
+        credentials=credentials,
+    )
+    try:
+        with patch("sigv4_kms.time.sleep") as mock_sleep:
+            result = client.encrypt(KeyId="key-1", Plaintext="secret")
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+    assert result["CiphertextBlob"] == b"encrypted"
+    mock_sleep.assert_called_once()
+
+
+def test_unparseable_errors_are_retried(credentials):
+    responses = [
+        (502, b"<html>Bad Gateway</html>"),
+        (502, b"<html>Bad Gateway</html>"),
+        (200, b'{"KeyId": "key-1", "CiphertextBlob": "ZW5jcnlwdGVk"}'),
+    ]
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status, payload = responses.pop(0)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ProxyHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    single = KMSClient(
+        region="us-west-2", endpoint_url=url, max_attempts=1, credentials=credentials
+    )
+    client = KMSClient(region="us-west-2", endpoint_url=url, credentials=credentials)
+    try:
+        with pytest.raises(KMSClientError) as e:
+            single.encrypt(KeyId="key-1", Plaintext="secret")
+        with patch("sigv4_kms.time.sleep"):
+            result = client.encrypt(KeyId="key-1", Plaintext="secret")
+    finally:
+        single.close()
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+    assert e.value.response["ResponseMetadata"]["HTTPStatusCode"] == 502
+    assert index.kms_retryable(e.value)
+    assert result["CiphertextBlob"] == b"encrypted"
+
+
+def test_closed_idle_connections_are_replaced(credentials):
+    connections = []
+
+    class ClosingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            payload = b'{"KeyId": "key-1", "CiphertextBlob": "ZW5jcnlwdGVk"}'
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            # Close the connection once idle, without telling the client
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ClosingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    client = KMSClient(
+        region="us-west-2",
+        endpoint_url=f"http://127.0.0.1:{server.server_address[1]}",
+        max_attempts=1,
+        credentials=credentials,
+    )
+    try:
+        with patch("sigv4_kms.time.sleep") as mock_sleep:
+            for _ in range(3):
+                result = client.encrypt(KeyId="key-1", Plaintext="secret")
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+    assert result["CiphertextBlob"] == b"encrypted"
+    assert len(connections) == 3
+    mock_sleep.assert_not_called()
+
+
+def test_access_denied_is_not_retried(credentials):
+    client = KMSClient(
+        region="us-west-2", endpoint_url="http://kms.test", credentials=credentials
+    )
+    with patch.object(
+        client, "send", return_value=(400, {"__type": "AccessDeniedException"})
+    ) as mock_send:
+        with pytest.raises(KMSClientError) as e:
+            client.encrypt(KeyId="key-1", Plaintext="secret")
+    assert index.kms_error_code(e.value) == "AccessDeniedException"
+    mock_send.assert_called_once()
+
+
+def test_container_credentials_are_cached(monkeypatch):
+    monkeypatch.delenv("AWS_ACCESS_KEY_ID", raising=False)
+    monkeypatch.delenv("AWS_SECRET_ACCESS_KEY", raising=False)
+    monkeypatch.setenv("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI", "/v2/credentials")
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.read.return_value = json.dumps(
+        {
+            "AccessKeyId": "AKID",
+            "SecretAccessKey": "secret",
+            "Token": "token",
+            "Expiration": "2999-01-01T00:00:00Z",
+        }
+    ).encode("utf-8")
+
+    credentials = Credentials()
+    with patch("sigv4_kms.urllib.request.urlopen", return_value=response) as mock:
+        assert credentials.get() == ("AKID", "secret", "token")
+        assert credentials.get() == ("AKID", "secret", "token")
+    assert mock.call_args.args[0].full_url == "http://169.254.170.2/v2/credentials"
+    mock.assert_called_once()
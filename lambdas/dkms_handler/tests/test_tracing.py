@@ -0,0 +1,200 @@
+import json
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+import index
+import tracing
+
+TRACE_ID = "5759e988bd862e3fe1be46a994272793"
+
+
+def encrypt_event(user_jwt, headers=None) -> dict:
+    return {
+        "rawPath": "/encrypt",
+        "requestContext": {"http": {"method": "POST"}},
+        "headers": {"authorization": f"Bearer {user_jwt}", **(headers or {})},
+        "body": json.dumps({"plaintext": "secret"}),
+    }
+
+
+def run_traced(event, monkeypatch, lambda_trace_header=None) -> list:
+    """Invoke the handler with tracing enabled and return the exported spans."""
+    if lambda_trace_header is None:
+        monkeypatch.delenv("_X_AMZN_TRACE_ID", raising=False)
+    else:
+        monkeypatch.setenv("_X_AMZN_TRACE_ID", lambda_trace_header)
+    exported = []
+    with patch("tracing.exporter_name", "log"), patch(
+        "tracing.export", exported.extend
+    ), patch("index.jwks_client", index.JWKSClient(index.jwks_url)):
+        tracing.traced(index.handler)(event, None)
+    return exported
+
+
+def test_traced_is_noop_when_disabled():
+    handler = lambda event, context: None
+    with patch("tracing.exporter_name", ""):
+        assert tracing.traced(handler) is handler
+
+
+def test_span_is_noop_outside_a_trace():
+    with tracing.span("authenticate") as span:
+        span.set("key", "value")
+    assert span is tracing.noop_span
+
+
+def test_context_from_headers(monkeypatch):
+    monkeypatch.delenv("_X_AMZN_TRACE_ID", raising=False)
+    with patch("tracing.trust_headers", True):
+        context = tracing.context_from_event(
+            {"headers": {"traceparent": f"00-{TRACE_ID}-53995c3f42cd8ad8-01"}}
+        )
+    assert (context.trace_id, context.parent_id, context.sampled) == (
+        TRACE_ID,
+        "53995c3f42cd8ad8",
+        True,
+    )
+
+    context = tracing.context_from_event(
+        {"headers": {"x-amzn-trace-id": "Root=1-5759e988-bd862e3fe1be46a994272793"}}
+    )
+    assert context.xray_trace_id == "1-5759e988-bd862e3fe1be46a994272793"
+    assert context.parent_id is None
+
+    with patch("tracing.sample_rate", 0):
+        assert not tracing.context_from_event({"headers": {}}).sampled
+    with patch("tracing.sample_rate", 1):
+        assert len(tracing.context_from_event({"headers": {}}).trace_id) == 32
+
+
+def test_untrusted_headers_cannot_force_sampling(monkeypatch):
+    monkeypatch.delenv("_X_AMZN_TRACE_ID", raising=False)
+    with patch("tracing.sample_rate", 0):
+        context = tracing.context_from_event(
+            {"headers": {"traceparent": f"00-{TRACE_ID}-53995c3f42cd8ad8-01"}}
+        )
+        assert (context.trace_id, context.sampled) == (TRACE_ID, False)
+        context = tracing.context_from_event(
+            {
+                "headers": {
+                    "x-amzn-trace-id": "Root=1-5759e988-bd862e3fe1be46a994272793;"
+                    "Sampled=1"
+                }
+            }
+        )
+        assert context.sampled is False
+
+
+def test_lambda_trace_header_takes_precedence(monkeypatch):
+    monkeypatch.setenv(
+        "_X_AMZN_TRACE_ID",
+        "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=0",
+    )
+    context = tracing.context_from_event(
+        {"headers": {"traceparent": f"00-{'0' * 31}1-{'0' * 15}1-01"}}
+    )
+    assert context.trace_id == TRACE_ID
+    assert context.sampled is False
+
+
+def test_request_spans(user_jwt, monkeypatch):
+    event = encrypt_event(
+        user_jwt, {"traceparent": f"00-{TRACE_ID}-53995c3f42cd8ad8-01"}
+    )
+    with patch(
+        "index.kms_client.encrypt", return_value={"CiphertextBlob": b"encrypted"}
+    ), patch("tracing.trust_headers", True):
+        spans = {s.name: s for s in run_traced(event, monkeypatch)}
+
+    root = spans["dkms-customer-api"]
+    assert root.parent_id == "53995c3f42cd8ad8"
+    assert root.attributes["http.status_code"] == 200
+    assert spans["authenticate"].parent_id == root.span_id
+    assert spans["jwks.refresh"].parent_id == spans["authenticate"].span_id
+    assert spans["kms.encrypt"].parent_id == root.span_id
+    assert spans["KMS"].parent_id == spans["kms.encrypt"].span_id
+    assert spans["KMS"].attributes == {"attempt": 1, "aws.operation": "encrypt"}
+    assert spans["serialize"].parent_id == root.span_id
+    assert {s.trace.trace_id for s in spans.values()} == {TRACE_ID}
+
+
+def test_unsampled_request_exports_nothing(user_jwt, monkeypatch):
+    event = encrypt_event(
+        user_jwt, {"traceparent": f"00-{TRACE_ID}-53995c3f42cd8ad8-00"}
+    )
+    with patch(
+        "index.kms_client.encrypt", return_value={"CiphertextBlob": b"encrypted"}
+    ):
+        assert run_traced(event, monkeypatch) == []
+
+
+def test_kms_retry_attempts_are_spans(monkeypatch):
+    monkeypatch.delenv("_X_AMZN_TRACE_ID", raising=False)
+    throttled = ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "slow down"}}, "Encrypt"
+    )
+    with patch("tracing.exporter_name", "log"), patch("tracing.sample_rate", 1), patch(
+        "tracing.export"
+    ) as mock_export, patch(
+        "index.kms_client.encrypt",
+        side_effect=[throttled, {"CiphertextBlob": b"encrypted"}],
+    ), patch(
+        "index.time.sleep"
+    ):
+        tracing.traced(
+            lambda event, context: {
+                "statusCode": 200,
+                "result": index.kms_call("encrypt", 2, KeyId="key"),
+            }
+        )({"headers": {}}, None)
+
+    spans = mock_export.call_args.args[0]
+    attempts = [s for s in spans if s.name == "KMS"]
+    assert [s.attributes["attempt"] for s in attempts] == [1, 2]
+    assert attempts[0].attributes["aws.error_code"] == "ThrottlingException"
+    assert attempts[0].error == "ClientError"
+    assert attempts[1].error is None
+    call = next(s for s in spans if s.name == "kms.encrypt")
+    assert call.attributes["attempts"] == 2
+
+    document = tracing.xray_document(attempts[0], in_lambda=False)
+    assert document["type"] == "subsegment"
+    assert document["namespace"] == "aws"
+    assert document["throttle"] is True
+
+
+def test_xray_documents_nest_under_lambda_segment(user_jwt, monkeypatch):
+    with patch(
+        "index.kms_client.encrypt", return_value={"CiphertextBlob": b"encrypted"}
+    ):
+        spans = run_traced(
+            encrypt_event(user_jwt),
+            monkeypatch,
+            lambda_trace_header="Root=1-5759e988-bd862e3fe1be46a994272793;"
+            "Parent=53995c3f42cd8ad8;Sampled=1",
+        )
+
+    root = tracing.xray_document(spans[-1], in_lambda=True)
+    assert root["type"] == "subsegment"
+    assert root["trace_id"] == "1-5759e988-bd862e3fe1be46a994272793"
+    assert root["parent_id"] == "53995c3f42cd8ad8"
+    assert root["annotations"]["http_status_code"] == 200
+    assert "type" not in tracing.xray_document(spans[-1], in_lambda=False)
+
+
+def test_send_to_daemon(monkeypatch):
+    span = tracing.Span("serialize", tracing.TraceContext(TRACE_ID), None, "internal")
+    span.end_time = span.start_time + 0.001
+    monkeypatch.delenv("_X_AMZN_TRACE_ID", raising=False)
+    with patch("tracing.daemon_address", "127.0.0.1:2000"), patch(
+        "tracing.socket.socket"
+    ) as mock_socket:
+        tracing.send_to_daemon([span])
+
+    sock = mock_socket.return_value.__enter__.return_value
+    payload, address = sock.sendto.call_args.args
+    header, document = payload.split(b"\n", 1)
+    assert json.loads(header) == {"format": "json", "version": 1}
+    assert json.loads(document)["id"] == span.span_id
+    assert address == ("127.0.0.1", 2000)
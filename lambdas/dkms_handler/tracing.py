@@ -0,0 +1,256 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Where to send spans: "xray" (the X-Ray daemon or an ADOT collector's X-Ray
+# receiver, over UDP) or "log" (one JSON log line per span). When unset,
+# handlers are returned undecorated and spans are no-ops.
+exporter_name = os.getenv("DKMS_TRACING", "")
+# Head-based sampling for requests that arrive without a trusted sampling
+# decision. The Lambda runtime's decision is always honored. Callers could
+# otherwise force every request to be traced, so a sampled flag in request
+# headers is only honored when they come from a trusted proxy.
+sample_rate = float(os.getenv("DKMS_TRACE_SAMPLE_RATE", "0.05"))
+trust_headers = os.getenv("DKMS_TRACE_TRUST_HEADERS", "").lower() == "true"
+service_name = os.getenv("DKMS_TRACE_SERVICE_NAME", "dkms-customer-api")
+daemon_address = os.getenv("AWS_XRAY_DAEMON_ADDRESS", "127.0.0.1:2000")
+
+current = threading.local()
+
+
+class TraceContext:
+    """The trace an incoming request belongs to and its sampling decision."""
+
+    def __init__(self, trace_id: str, parent_id: str = None, sampled: bool = None):
+        self.trace_id = trace_id  # 32 hex characters, as in W3C trace context
+        self.parent_id = parent_id
+        self.sampled = sampled
+
+    @classmethod
+    def from_traceparent(cls, header: str):
+        """Parse a W3C traceparent header, e.g. "00-<trace>-<parent>-01"."""
+        try:
+            version, trace_id, parent_id, flags = header.strip().split("-")[:4]
+            int(trace_id, 16), int(parent_id, 16)
+            sampled = bool(int(flags, 16) & 1)
+        except ValueError:
+            return None
+        if len(trace_id) != 32 or len(parent_id) != 16:
+            return None
+        return cls(trace_id.lower(), parent_id.lower(), sampled)
+
+    @classmethod
+    def from_xray(cls, header: str):
+        """Parse an X-Ray header, e.g. "Root=1-<time>-<id>;Parent=<id>;Sampled=1"."""
+        fields = dict(
+            part.strip().split("=", 1) for part in header.split(";") if "=" in part
+        )
+        root = fields.get("Root", "").split("-")
+        if len(root) != 3 or len(root[1]) != 8 or len(root[2]) != 24:
+            return None
+        sampled = {"1": True, "0": False}.get(fields.get("Sampled"))
+        return cls(root[1] + root[2], fields.get("Parent"), sampled)
+
+    @property
+    def xray_trace_id(self) -> str:
+        return f"1-{self.trace_id[:8]}-{self.trace_id[8:]}"
+
+
+class Span:
+    """A timed operation within a sampled trace."""
+
+    def __init__(self, name: str, trace: TraceContext, parent_id: str, kind: str):
+        self.name = name
+        self.trace = trace
+        self.parent_id = parent_id
+        self.kind = kind  # "server" for the request, "client" for outgoing calls
+        self.span_id = os.urandom(8).hex()
+        self.attributes = {}
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+
+class NoopSpan:
+    """Stands in for a span when the request is not traced."""
+
+    def set(self, key: str, value) -> None:
+        pass
+
+
+noop_span = NoopSpan()
+
+
+def context_from_event(event) -> TraceContext:
+    """Return the trace context of an invocation, starting a new trace if needed.
+
+    In Lambda the runtime's trace header takes precedence, so spans nest under
+    the function segment. Otherwise W3C and X-Ray request headers are joined,
+    but a request to be sampled is only honored with DKMS_TRACE_TRUST_HEADERS.
+    """
+    headers = event.get("headers") or {}
+    candidates = [
+        (TraceContext.from_xray, os.getenv("_X_AMZN_TRACE_ID"), True),
+        (TraceContext.from_traceparent, headers.get("traceparent"), trust_headers),
+        (TraceContext.from_xray, headers.get("x-amzn-trace-id"), trust_headers),
+    ]
+    for parse, header, trusted in candidates:
+        context = parse(header) if header else None
+        if context is not None:
+            if context.sampled and not trusted:
+                context.sampled = None  # Sample at the local rate instead
+            break
+    else:
+        # X-Ray trace ids start with the epoch time in seconds
+        context = TraceContext(f"{int(time.time()):08x}" + os.urandom(12).hex())
+    if context.sampled is None:
+        context.sampled = random.random() < sample_rate
+    return context
+
+
+def traced(fn):
+    """Trace invocations of a Lambda handler when tracing is enabled."""
+    if not exporter_name:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(event, context):
+        trace = context_from_event(event)
+        if not trace.sampled:
+            return fn(event, context)
+
+        root = Span(service_name, trace, trace.parent_id, "server")
+        root.set(
+            "http.method", event.get("requestContext", {}).get("http", {}).get("method")
+        )
+        root.set("http.target", event.get("rawPath"))
+        current.spans = [root]
+        current.finished = []
+        try:
+            response = fn(event, context)
+            status = response.get("statusCode")
+            root.set("http.status_code", status)
+            if status is not None and status >= 400:
+                root.error = f"HTTP {status}"
+            return response
+        except Exception as e:
+            root.error = type(e).__name__
+            raise
+        finally:
+            root.end_time = time.time()
+            spans = current.finished + [root]
+            current.spans = None
+            export(spans)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """Time a block as a child of the current span, if the request is traced."""
+    stack = getattr(current, "spans", None)
+    if not stack:
+        yield noop_span
+        return
+
+    child = Span(name, stack[0].trace, stack[-1].span_id, kind)
+    child.attributes.update(attributes)
+    stack.append(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = child.error or type(e).__name__
+        raise
+    finally:
+        child.end_time = time.time()
+        stack.pop()
+        current.finished.append(child)
+
+
+def export(spans: list) -> None:
+    """Send finished spans to the configured exporter, never failing the request."""
+    try:
+        if exporter_name == "xray":
+            send_to_daemon(spans)
+        elif exporter_name == "log":
+            for s in spans:
+                logger.info(log_record(s))
+    except Exception:
+        logger.exception("failed to export trace")
+
+
+def log_record(s: Span) -> dict:
+    """Return a span as a log record using OpenTelemetry field names."""
+    return {
+        "message": "span",
+        "name": s.name,
+        "kind": s.kind,
+        "trace_id": s.trace.trace_id,
+        "span_id": s.span_id,
+        "parent_span_id": s.parent_id,
+        "start_time": s.start_time,
+        "duration_ms": round((s.end_time - s.start_time) * 1000, 3),
+        "status": "ERROR" if s.error else "OK",
+        "error": s.error,
+        "attributes": s.attributes,
+    }
+
+
+def xray_document(s: Span, in_lambda: bool) -> dict:
+    """Return a span as an X-Ray segment or subsegment document."""
+    document = {
+        "name": s.name,
+        "id": s.span_id,
+        "trace_id": s.trace.xray_trace_id,
+        "start_time": s.start_time,
+        "end_time": s.end_time,
+    }
+    if s.parent_id is not None:
+        document["parent_id"] = s.parent_id
+    # Lambda records the function segment itself, so everything nests under it
+    if s.kind != "server" or in_lambda:
+        document["type"] = "subsegment"
+    if s.kind == "client":
+        operation = s.attributes.get("aws.operation")
+        document["namespace"] = "aws" if operation else "remote"
+        if operation:
+            document["aws"] = {"operation": operation}
+    if s.attributes:
+        document["metadata"] = {"default": s.attributes}
+        document["annotations"] = {
+            key.replace(".", "_"): value
+            for key, value in s.attributes.items()
+            if isinstance(value, (str, int, float, bool))
+        }
+    if s.error is not None:
+        status = s.attributes.get("http.status_code") or 500
+        if s.attributes.get("aws.error_code") == "ThrottlingException":
+            document["throttle"] = document["error"] = True
+        else:
+            document["fault" if status >= 500 else "error"] = True
+        document["cause"] = {"exceptions": [{"message": s.error}]}
+    return document
+
+
+def send_to_daemon(spans: list) -> None:
+    """Send spans to the X-Ray daemon, one UDP datagram per document."""
+    host, _, port = daemon_address.rpartition(":")
+    in_lambda = os.getenv("_X_AMZN_TRACE_ID") is not None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for s in spans:
+            payload = json.dumps(xray_document(s, in_lambda), default=str)
+            sock.sendto(
+                b'{"format": "json", "version": 1}\n' + payload.encode("utf-8"),
+                (host, int(port)),
+            )
@@ -0,0 +1,108 @@
+"""Load profiles, request mixes and reports for the end-to-end.py load test."""
+import argparse
+import math
+import threading
+from collections import Counter, defaultdict
+
+OPERATIONS = ("healthz", "encrypt", "decrypt", "roundtrip")
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse a request mix like "roundtrip=1,decrypt=3" into weights."""
+    weights = {}
+    for part in mix.split(","):
+        operation, _, weight = part.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        weights[operation] = float(weight or 1)
+        if weights[operation] < 0:
+            raise argparse.ArgumentTypeError(f"negative weight for {operation}")
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError("at least one weight must be positive")
+    return weights
+
+
+def concurrency_at(args: argparse.Namespace, elapsed: float) -> int:
+    """Return the number of active workers `elapsed` seconds into the test."""
+    if args.profile == "ramp":
+        # Spend an equal share of the test at each level
+        progress = min(elapsed / args.duration, 1.0)
+        levels = args.concurrency - args.start_concurrency + 1
+        return min(args.start_concurrency + int(progress * levels), args.concurrency)
+    if args.profile == "step":
+        steps = int(elapsed // args.step_duration)
+        return min(args.start_concurrency + steps * args.step_size, args.concurrency)
+    return args.concurrency
+
+
+def percentile(values: list, pct: float) -> float:
+    """Return the nearest-rank percentile of a list of values.
+
+    The same as replay.percentile, which runs with the handler's dependencies
+    rather than these.
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies: list) -> dict:
+    """Return latency percentiles in milliseconds, all 0 if there are none."""
+    if not latencies:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "max_ms": round(max(latencies), 1),
+    }
+
+
+class Results:
+    """Collect the outcome of every request made during a load test."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.error_codes = defaultdict(Counter)
+        self.levels = defaultdict(lambda: {"latencies": [], "errors": 0})
+        self.integrity_failures = 0
+
+    def record(self, route: str, latency_ms: float, error_code: str, level: int):
+        with self.lock:
+            self.latencies[route].append(latency_ms)
+            self.levels[level]["latencies"].append(latency_ms)
+            if error_code:
+                self.error_codes[route][error_code] += 1
+                self.levels[level]["errors"] += 1
+
+    def record_integrity_failure(self):
+        with self.lock:
+            self.integrity_failures += 1
+
+    def report(self, elapsed: float) -> dict:
+        with self.lock:
+            requests_made = sum(len(v) for v in self.latencies.values())
+            return {
+                "duration_s": round(elapsed, 1),
+                "requests": requests_made,
+                "throughput_rps": round(requests_made / elapsed, 1) if elapsed else 0,
+                "integrity_failures": self.integrity_failures,
+                "routes": {
+                    route: {
+                        "requests": len(latencies),
+                        "errors": sum(self.error_codes[route].values()),
+                        **summarize(latencies),
+                        "error_codes": dict(self.error_codes[route]),
+                    }
+                    for route, latencies in sorted(self.latencies.items())
+                },
+                "concurrency": {
+                    level: {
+                        "requests": len(stats["latencies"]),
+                        "errors": stats["errors"],
+                        **summarize(stats["latencies"]),
+                    }
+                    for level, stats in sorted(self.levels.items())
+                },
+            }
@@ -1,3 +1,5 @@
+import json
+
 import aws_cdk as cdk
 import aws_cdk.assertions as assertions
 
@@ -59,5 +61,363 @@ def test_dkms_api_stack_all_options():
         cors_allow_origins="*",
         domain_name="example.com",
         acm_cert_arn="arn:aws:acm:us-west-2:01234567890:certificate/f278cd4d-e846-4063-bb00-bd15c382bb41",
+        metrics_admin_claim="dkms_admin",
+        kms_client="sigv4",
+    )
+    template = assertions.Template.from_stack(stack)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {
+                        "DKMS_METRICS_ADMIN_CLAIM": "dkms_admin",
+                        "DKMS_KMS_CLIENT": "sigv4",
+                    }
+                )
+            },
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Route",
+        {"RouteKey": "GET /metrics"},
+    )
+
+
+def test_dkms_api_stack_bulk_jobs():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        enable_bulk_jobs=True,
+        enable_fargate=True,
+        kms_client="sigv4",
+        enable_tracing=True,
+    )
+    template = assertions.Template.from_stack(stack)
+    template.resource_count_is("AWS::S3::Bucket", 1)
+    template.has_resource_properties(
+        "AWS::S3::Bucket",
+        {
+            "BucketEncryption": {
+                "ServerSideEncryptionConfiguration": [
+                    assertions.Match.object_like({"BucketKeyEnabled": True})
+                ]
+            }
+        },
+    )
+    template.resource_count_is("AWS::SQS::Queue", 2)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "index.job_worker_handler",
+            "Timeout": 300,
+            "TracingConfig": {"Mode": "Active"},
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"DKMS_KMS_CLIENT": "sigv4", "DKMS_TRACING": "xray"}
+                )
+            },
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::EventSourceMapping",
+        {
+            "BatchSize": 1,
+            "FunctionResponseTypes": ["ReportBatchItemFailures"],
+            "ScalingConfig": {"MaximumConcurrency": 2},
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "index.job_dead_letter_handler"},
+    )
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Route",
+        {"RouteKey": "GET /jobs/{job_id}"},
+    )
+    template.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {
+            "ContainerDefinitions": assertions.Match.array_with(
+                [
+                    assertions.Match.object_like(
+                        {
+                            "Environment": assertions.Match.array_with(
+                                [
+                                    {
+                                        "Name": "DKMS_JOB_BUCKET",
+                                        "Value": assertions.Match.any_value(),
+                                    },
+                                    {
+                                        "Name": "DKMS_JOB_QUEUE_URL",
+                                        "Value": assertions.Match.any_value(),
+                                    },
+                                ]
+                            )
+                        }
+                    )
+                ]
+            ),
+        },
+    )
+
+
+def test_dkms_api_stack_fargate():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        enable_fargate=True,
+    )
+    template = assertions.Template.from_stack(stack)
+    template.resource_count_is("AWS::ECS::Service", 1)
+    template.resource_count_is("AWS::ElasticLoadBalancingV2::LoadBalancer", 1)
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::TargetGroup",
+        {"HealthCheckPath": "/healthz", "Port": 80},
+    )
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::LoadBalancer", {"Scheme": "internal"}
+    )
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::Listener", {"Port": 80, "Protocol": "HTTP"}
+    )
+    template.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {
+            "Cpu": "256",
+            "Memory": "512",
+            "ContainerDefinitions": [
+                assertions.Match.object_like(
+                    {"PortMappings": [{"ContainerPort": 8080, "Protocol": "tcp"}]}
+                )
+            ],
+        },
+    )
+
+
+def test_dkms_api_stack_fargate_domain():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        enable_fargate=True,
+        fargate_domain_name="dkms.example.com",
+        fargate_hosted_zone_id="Z0123456789",
+        fargate_hosted_zone_name="example.com",
+    )
+    template = assertions.Template.from_stack(stack)
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::LoadBalancer", {"Scheme": "internet-facing"}
+    )
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::Listener", {"Port": 443, "Protocol": "HTTPS"}
+    )
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::Listener",
+        {
+            "Port": 80,
+            "DefaultActions": [
+                assertions.Match.object_like({"Type": "redirect"}),
+            ],
+        },
+    )
+    template.has_resource_properties(
+        "AWS::CertificateManager::Certificate", {"DomainName": "dkms.example.com"}
+    )
+    template.has_resource_properties(
+        "AWS::Route53::RecordSet",
+        {"Name": "dkms.example.com.", "Type": "A", "HostedZoneId": "Z0123456789"},
+    )
+
+
+def test_dkms_api_stack_rate_limits():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        tenant_rate_limit=20,
+        tenant_burst_limit=40,
+        shared_tenant_limits=True,
+        api_throttle_rate_limit=500,
+        api_throttle_burst_limit=1000,
+        enable_bulk_jobs=True,
+        enable_fargate=True,
     )
     template = assertions.Template.from_stack(stack)
+    template.resource_count_is("AWS::DynamoDB::Table", 1)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "index.job_worker_handler",
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {
+                        "DKMS_TENANT_RATE": "20",
+                        "DKMS_TENANT_TABLE": assertions.Match.any_value(),
+                    }
+                )
+            },
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"DKMS_TENANT_RATE": "20", "DKMS_TENANT_BURST": "40"}
+                )
+            },
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {
+            "ContainerDefinitions": assertions.Match.array_with(
+                [
+                    assertions.Match.object_like(
+                        {
+                            "Environment": assertions.Match.array_with(
+                                [
+                                    {"Name": "DKMS_TENANT_RATE", "Value": "20"},
+                                    {"Name": "DKMS_TENANT_BURST", "Value": "40"},
+                                ]
+                            )
+                        }
+                    )
+                ]
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::Stage",
+        {
+            "DefaultRouteSettings": {
+                "ThrottlingRateLimit": 500,
+                "ThrottlingBurstLimit": 1000,
+            },
+        },
+    )
+
+
+def test_dkms_api_stack_tracing():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        enable_fargate=True,
+        enable_tracing=True,
+        trace_sample_rate=0.1,
+    )
+    template = assertions.Template.from_stack(stack)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "TracingConfig": {"Mode": "Active"},
+            "Environment": {
+                "Variables": assertions.Match.object_like(
+                    {"DKMS_TRACING": "xray", "DKMS_TRACE_SAMPLE_RATE": "0.1"}
+                )
+            },
+        },
+    )
+    template.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {
+            "ContainerDefinitions": assertions.Match.array_with(
+                [
+                    assertions.Match.object_like(
+                        {
+                            "Name": "xray-daemon",
+                            "PortMappings": [
+                                {"ContainerPort": 2000, "Protocol": "udp"}
+                            ],
+                        }
+                    )
+                ]
+            ),
+        },
+    )
+
+
+def test_dkms_api_stack_tenant_keys():
+    app = cdk.App()
+    env_name = "test"
+    stack = DKMSCustomerAPIStack(
+        app,
+        f"dkms-customer-api-{env_name}",
+        env_name=env_name,
+        jwks_url=test_jwks_url,
+        cors_allow_origins="*",
+        enable_bulk_jobs=True,
+        enable_fargate=True,
+        tenant_keys=["app-1", "app-2"],
+    )
+    template = assertions.Template.from_stack(stack)
+    template.resource_count_is("AWS::KMS::Key", 3)
+    template.has_resource_properties(
+        "AWS::KMS::Alias", {"AliasName": "alias/dkms-customer-key-test-app-1"}
+    )
+    template.has_resource_properties(
+        "AWS::SSM::Parameter",
+        {
+            "Name": "/dkms-customer-api/test/key-routes",
+            "Value": json.dumps(
+                {
+                    "app-1": "alias/dkms-customer-key-test-app-1",
+                    "app-2": "alias/dkms-customer-key-test-app-2",
+                }
+            ),
+        },
+    )
+    environment = {
+        "Environment": {
+            "Variables": assertions.Match.object_like(
+                {"DKMS_KEY_ROUTES_PARAMETER": assertions.Match.any_value()}
+            )
+        }
+    }
+    functions = template.find_resources(
+        "AWS::Lambda::Function", {"Properties": environment}
+    )
+    assert len(functions) == 2
+
+    # The API, job worker and Fargate task may all describe the shared key
+    shared_key = stack.get_logical_id(stack.kms_key.node.default_child)
+    describe_shared_key = {
+        "Action": "kms:DescribeKey",
+        "Effect": "Allow",
+        "Resource": {"Fn::GetAtt": [shared_key, "Arn"]},
+    }
+    policies = template.find_resources(
+        "AWS::IAM::Policy",
+        {
+            "Properties": {
+                "PolicyDocument": {
+                    "Statement": assertions.Match.array_with([describe_shared_key])
+                }
+            }
+        },
+    )
+    assert len(policies) == 3
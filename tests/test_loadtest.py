@@ -0,0 +1,89 @@
+import argparse
+
+import pytest
+
+import loadtest
+
+
+def profile(name: str, **kwargs) -> argparse.Namespace:
+    options = {
+        "profile": name,
+        "duration": 100,
+        "concurrency": 5,
+        "start_concurrency": 1,
+        "step_size": 2,
+        "step_duration": 30,
+    }
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def test_parse_mix():
+    assert loadtest.parse_mix("roundtrip=1,decrypt=3") == {
+        "roundtrip": 1.0,
+        "decrypt": 3.0,
+    }
+    assert loadtest.parse_mix("healthz") == {"healthz": 1.0}
+    for mix in ("upload=1", "encrypt=-1", "encrypt=0"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            loadtest.parse_mix(mix)
+
+
+def test_constant_profile_holds_concurrency():
+    args = profile("constant")
+    assert [loadtest.concurrency_at(args, t) for t in (0, 50, 200)] == [5, 5, 5]
+
+
+def test_ramp_profile_spends_equal_time_per_level():
+    args = profile("ramp")
+    levels = [loadtest.concurrency_at(args, t) for t in (0, 19.9, 20, 60, 99.9, 150)]
+    assert levels == [1, 1, 2, 4, 5, 5]
+
+
+def test_step_profile_adds_workers_per_step():
+    args = profile("step")
+    levels = [loadtest.concurrency_at(args, t) for t in (0, 29.9, 30, 60, 90)]
+    assert levels == [1, 1, 3, 5, 5]
+
+
+def test_percentile_and_summarize():
+    values = list(range(100, 0, -1))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([7], 95) == 7
+    assert loadtest.summarize([3.0, 1.0, 2.0]) == {
+        "p50_ms": 2.0,
+        "p95_ms": 3.0,
+        "p99_ms": 3.0,
+        "max_ms": 3.0,
+    }
+    assert loadtest.summarize([]) == {
+        "p50_ms": 0.0,
+        "p95_ms": 0.0,
+        "p99_ms": 0.0,
+        "max_ms": 0.0,
+    }
+
+
+def test_results_report_by_route_and_level():
+    results = loadtest.Results()
+    results.record("encrypt", 10.0, "", 1)
+    results.record("encrypt", 30.0, "RATE_LIMITED", 2)
+    results.record("decrypt", 20.0, "", 2)
+    results.record_integrity_failure()
+
+    report = results.report(elapsed=2.0)
+    assert report["requests"] == 3
+    assert report["throughput_rps"] == 1.5
+    assert report["integrity_failures"] == 1
+    assert report["routes"]["encrypt"]["errors"] == 1
+    assert report["routes"]["encrypt"]["error_codes"] == {"RATE_LIMITED": 1}
+    assert report["routes"]["encrypt"]["max_ms"] == 30.0
+    assert report["concurrency"][2] == {
+        "requests": 2,
+        "errors": 1,
+        "p50_ms": 20.0,
+        "p95_ms": 30.0,
+        "p99_ms": 30.0,
+        "max_ms": 30.0,
+    }